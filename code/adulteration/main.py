@@ -1,20 +1,24 @@
-import os, sys, random, argparse, time, math, gzip
+import os, sys, random, argparse, time, math, gzip, threading, hashlib, inspect, glob, json, shutil
 import cPickle as pickle
-from collections import Counter
+import Queue
+from collections import Counter, OrderedDict
 
 import numpy as np
 import scipy
+import scipy.sparse
 from sklearn.cross_validation import train_test_split
-from sklearn.decomposition import PCA
 import theano
 import theano.tensor as T
 
 sys.path.append('../')
 sys.path.append('../../../adulteration/wikipedia')
 sys.path.append('../../../adulteration/model')
-from nn import get_activation_by_name, create_optimization_updates, softmax, sigmoid
-from nn import Layer, EmbeddingLayer, LSTM, RCNN, StrCNN, Dropout, apply_dropout
+from nn import get_activation_by_name, create_optimization_updates, get_optimizer_state, softmax, sigmoid
+from nn import FlatParams
+from nn import Layer, EmbeddingLayer, LSTM, RCNN, ParallelRCNN, StrCNN, Dropout, apply_dropout
 from utils import say, load_embedding_iterator
+from utils import save_embedding_matrix, load_embedding_matrix, convert_embedding_file
+from utils import filter_embeddings
 
 import hier_to_cat
 import scoring
@@ -28,18 +32,67 @@ def convert_to_zero_one(v):
     """Convert probability distribution to zero (not occured) or one (occured)."""
     return (v>0).astype('int32')
 
-def reduce_dim(hier_x, n_components, saved=True):
-    fname = 'pca_{}.pkl'.format(n_components)
+def sparse_pca(X, n_components, n_oversamples=10, n_iter=7, seed=0):
+    """Principal components of a sparse matrix by randomized SVD.
+
+    The columns are centered implicitly, so X is never densified. Returns the
+    column means and the (n_components, n_features) components.
+    """
+    rng = np.random.RandomState(seed)
+    X = scipy.sparse.csr_matrix(X, dtype='float64')
+    Xt = X.T.tocsr()
+    mean = np.asarray(X.mean(axis=0)).ravel()
+    # products with the centered matrix X - 1*mean
+    dot = lambda M: X.dot(M) - mean.dot(M)[None,:]
+    tdot = lambda M: Xt.dot(M) - np.outer(mean, M.sum(axis=0))
+    k = min(n_components + n_oversamples, min(X.shape))
+    Q = dot(rng.normal(size=(X.shape[1], k)))
+    for i in range(n_iter):
+        Q = np.linalg.qr(Q)[0]
+        Q = dot(np.linalg.qr(tdot(Q))[0])
+    Q = np.linalg.qr(Q)[0]
+    _, _, Vt = np.linalg.svd(tdot(Q).T, full_matrices=False)
+    return mean, Vt[:n_components]
+
+def hash_sparse(X):
+    h = hashlib.md5(str(X.shape))
+    for a in (X.data, X.indices, X.indptr):
+        h.update(np.ascontiguousarray(a).data)
+    return h.hexdigest()
+
+def reduce_dim(hier_x, n_components, fit_x=None, saved=True):
+    """Project the sparse hier features on the top principal components of
+    fit_x (default: hier_x). The projection is cached in a file keyed by a
+    hash of fit_x."""
+    if fit_x is None:
+        fit_x = hier_x
+    fit_x = scipy.sparse.csr_matrix(fit_x)
+    fname = 'pca_{}_{}.npz'.format(n_components, hash_sparse(fit_x))
     if saved and os.path.isfile(fname):
-        with open(fname, 'r') as f:
-            pca = pickle.load(f)
-        hier_x_new = pca.transform(hier_x)
+        pca = np.load(fname)
+        mean, components = pca['mean'], pca['components']
     else:
-        pca = PCA(n_components=n_components)
-        hier_x_new = pca.fit_transform(hier_x)
-        with open(fname, 'w') as f:
-            pickle.dump(pca, f)
-    return hier_x_new
+        mean, components = sparse_pca(fit_x, n_components)
+        if saved:
+            np.savez(fname, mean=mean, components=components)
+    hier_x_new = scipy.sparse.csr_matrix(hier_x).dot(components.T) - mean.dot(components.T)
+    return hier_x_new.astype('float32')
+
+def hier_to_csr(ing_idx_to_hier_map, ids, n_features=3751):
+    """Sparse hier features, row k being those of ingredient ids[k] (zero if it has none)."""
+    indptr, indices, data = [ 0 ], [ ], [ ]
+    for i in ids:
+        hier = ing_idx_to_hier_map.get(i)
+        if hier is not None:
+            hier = np.asarray(hier).ravel()
+            assert len(hier) == n_features
+            nz = np.flatnonzero(hier)
+            indices.extend(nz)
+            data.extend(hier[nz])
+        indptr.append(len(indices))
+    return scipy.sparse.csr_matrix((np.array(data, dtype='float32'),
+            np.array(indices, dtype='int32'), np.array(indptr, dtype='int32')),
+            shape=(len(ids), n_features))
 
 def create_product_mask(products_len, n_hidden):
     mask = []
@@ -68,7 +121,7 @@ def read_corpus_products():
 def read_corpus_adulterants():
     with open(wiki_path+'input_to_outputs_adulterants.pkl', 'r') as f_in:
         input_to_outputs = pickle.load(f_in)
-    corpus_x, corpus_y, hier_x = [], [], []
+    corpus_x, corpus_y, hier_ids = [], [], []
     adulterants = get_adulterants(get_all=True)
     assert len(adulterants) == len(input_to_outputs)
     input_keys = range(len(adulterants))
@@ -78,7 +131,6 @@ def read_corpus_adulterants():
     for i in range(len(input_keys)):
         inp = input_keys[i]
         tokens = input_tokens[i]
-        hier = ing_idx_to_hier_map.get(i, np.zeros(3751))
         out = input_to_outputs[inp]
         if out.sum() <= 0:
             continue
@@ -86,18 +138,19 @@ def read_corpus_adulterants():
             corpus_x.append(tokens)
         else:
             corpus_x.append([])
-        hier_x.append(hier)
+        hier_ids.append(i)
         normalized = out*1. / out.sum()
         assert np.isclose(normalized.sum(), 1, atol=1e-5)
         corpus_y.append(normalized)
         #len_corpus_y.append(out.sum())
-    assert len(corpus_x)==len(corpus_y)==len(hier_x)
-    return np.array(corpus_x), np.array(corpus_y).astype('float32'), np.array(hier_x).astype('float32')
+    hier_x = hier_to_csr(ing_idx_to_hier_map, hier_ids)
+    assert len(corpus_x)==len(corpus_y)==hier_x.shape[0]
+    return np.array(corpus_x), np.array(corpus_y).astype('float32'), hier_x
 
 def read_corpus_ingredients(num_ingredients=5000):
     with open(wiki_path+'input_to_outputs.pkl', 'r') as f_in:
         input_to_outputs = pickle.load(f_in)
-    corpus_x, corpus_y, hier_x = [], [], []
+    corpus_x, corpus_y = [], []
     #y_indptr = [0]
     #y_indices = []
     #y_data = []
@@ -109,8 +162,6 @@ def read_corpus_ingredients(num_ingredients=5000):
     for i in range(num_ingredients):
         inp = input_keys[i]
         tokens = input_tokens[i]
-        hier = ing_idx_to_hier_map.get(i, np.zeros(3751))
-        assert len(hier) == 3751
         out = input_to_outputs[inp]
         assert out.sum() > 0, "Each ing must have a product category"
         #y_data.extend(out)
@@ -120,14 +171,283 @@ def read_corpus_ingredients(num_ingredients=5000):
             corpus_x.append(tokens)
         else:
             corpus_x.append([])
-        hier_x.append(hier)
         normalized = out*1. / out.sum()
         assert np.isclose(normalized.sum(), 1, atol=1e-5)
         corpus_y.append(normalized)
         #len_corpus_y.append(out.sum())
-    assert len(corpus_x)==len(corpus_y)==len(hier_x)
+    hier_x = hier_to_csr(ing_idx_to_hier_map, range(num_ingredients))
+    assert len(corpus_x)==len(corpus_y)==hier_x.shape[0]
     #corpus_y = scipy.sparse.csr_matrix((y_data, y_indices, np.cumsum(y_indptr)))
-    return np.array(corpus_x), np.array(corpus_y).astype('float32'), np.array(hier_x).astype('float32')
+    return np.array(corpus_x), np.array(corpus_y).astype('float32'), hier_x
+
+class RaggedCorpus:
+    """Tokenized articles stored as one flat int32 array of token ids.
+
+    Article i is data[starts[i]:ends[i]]. Until map_to_ids() is called the ids
+    index the corpus's own word list, afterwards they are embedding ids and
+    words is None. Indexing with an integer returns a view of the article,
+    indexing with a list or array of indices returns a new RaggedCorpus sharing
+    the same data, so splitting the corpus copies no tokens.
+    """
+    def __init__(self, data, starts, ends, words=None):
+        self.data = data
+        self.starts = starts
+        self.ends = ends
+        self.words = words
+
+    @classmethod
+    def from_lists(cls, token_lists):
+        word_ids = { }
+        words = [ ]
+        lengths = np.array([ len(tokens) for tokens in token_lists ], dtype='int64')
+        data = np.empty(lengths.sum(), dtype='int32')
+        pos = 0
+        for tokens in token_lists:
+            for token in tokens:
+                idx = word_ids.get(token)
+                if idx is None:
+                    idx = word_ids[token] = len(words)
+                    words.append(token)
+                data[pos] = idx
+                pos += 1
+        ends = np.cumsum(lengths)
+        return cls(data, ends - lengths, ends, words)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, i):
+        if isinstance(i, (int, long, np.integer)):
+            return self.data[self.starts[i]:self.ends[i]]
+        return RaggedCorpus(self.data, self.starts[i], self.ends[i], self.words)
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def lengths(self):
+        return self.ends - self.starts
+
+    def concatenate(self, other):
+        """Append the articles of other, merging the two word lists."""
+        assert self.words is not None and other.words is not None
+        word_ids = dict((w, i) for i, w in enumerate(self.words))
+        words = list(self.words)
+        table = np.empty(len(other.words), dtype='int32')
+        for j, w in enumerate(other.words):
+            if w not in word_ids:
+                word_ids[w] = len(words)
+                words.append(w)
+            table[j] = word_ids[w]
+        a, b = self.compact(), other.compact()
+        data = np.concatenate([ a.data, table[b.data] ])
+        return RaggedCorpus(data,
+                np.concatenate([ a.starts, b.starts + len(a.data) ]),
+                np.concatenate([ a.ends, b.ends + len(a.data) ]),
+                words)
+
+    def compact(self):
+        """Copy of the corpus that only holds the tokens of its own articles."""
+        lengths = self.lengths()
+        ends = np.cumsum(lengths)
+        starts = ends - lengths
+        data = np.empty(ends[-1] if len(ends) else 0, dtype='int32')
+        for i in xrange(len(self)):
+            data[starts[i]:ends[i]] = self[i]
+        return RaggedCorpus(data, starts, ends, self.words)
+
+    def map_to_ids(self, embedding_layer):
+        """Corpus of embedding ids, mapping each distinct word only once."""
+        table = np.asarray(embedding_layer.map_to_ids(self.words), dtype='int32')
+        return RaggedCorpus(table[self.data], self.starts, self.ends)
+
+    def save(self, path):
+        offsets = np.concatenate([ [0], np.cumsum(self.lengths()) ])
+        np.save(os.path.join(path, 'tokens.npy'), self.compact().data)
+        np.save(os.path.join(path, 'offsets.npy'), offsets)
+        np.save(os.path.join(path, 'words.npy'), np.array(self.words))
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        mmap_mode = 'r' if mmap else None
+        data = np.load(os.path.join(path, 'tokens.npy'), mmap_mode=mmap_mode)
+        offsets = np.load(os.path.join(path, 'offsets.npy'))
+        words = np.load(os.path.join(path, 'words.npy')).tolist()
+        return cls(data, offsets[:-1], offsets[1:], words)
+
+CORPUS_CACHE_VERSION = "2"
+
+def content_hash(files, values):
+    """md5 of the contents of the given files and the repr of the given values."""
+    h = hashlib.md5()
+    for fname in files:
+        with open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1<<20), ''):
+                h.update(chunk)
+    for value in values:
+        h.update(repr(value))
+    return h.hexdigest()
+
+def load_corpus(name, read_fn, input_files, values, cache_dir=""):
+    """Read a corpus as (RaggedCorpus, y, sparse hier), cached in cache_dir.
+
+    The cache entry is keyed by the contents of input_files, the sources of the
+    tokenizer and the hierarchy features, and values (e.g. the names of the
+    articles). It is a directory of .npy files that are memory-mapped on load.
+    """
+    if not cache_dir:
+        x_text, y, hier = read_fn()
+        return RaggedCorpus.from_lists(x_text), y, hier
+    code_files = [ inspect.getsourcefile(f) for f in (input_to_tokens, hier_to_cat) ]
+    key = content_hash(input_files + [ f for f in code_files if f ],
+            [ CORPUS_CACHE_VERSION ] + values)
+    path = os.path.join(cache_dir, "{}_{}".format(name, key))
+    if os.path.isdir(path):
+        print "Loading cached corpus:", path
+        return (RaggedCorpus.load(path),
+                np.load(os.path.join(path, 'y.npy'), mmap_mode='r'),
+                scipy.sparse.load_npz(os.path.join(path, 'hier.npz')))
+    x_text, y, hier = read_fn()
+    corpus = RaggedCorpus.from_lists(x_text)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    os.makedirs(tmp_path)
+    corpus.save(tmp_path)
+    np.save(os.path.join(tmp_path, 'y.npy'), y)
+    scipy.sparse.save_npz(os.path.join(tmp_path, 'hier.npz'), hier)
+    os.rename(tmp_path, path)
+    print "Cached corpus:", path
+    return corpus, y, hier
+
+def load_ingredients(cache_dir, num_ingredients=5000):
+    return load_corpus("ingredients",
+            lambda: read_corpus_ingredients(num_ingredients),
+            [ wiki_path+'input_to_outputs.pkl' ],
+            [ num_ingredients, list(get_ings(num_ingredients)) ], cache_dir)
+
+def load_adulterants(cache_dir):
+    return load_corpus("adulterants", read_corpus_adulterants,
+            [ wiki_path+'input_to_outputs_adulterants.pkl' ],
+            [ list(get_adulterants(get_all=True)) ], cache_dir)
+
+FUNCTION_CACHE_VERSION = "1"
+FUNCTION_CACHE_RECURSION_LIMIT = 50000
+
+# args that change the compiled graph; learning_rate and dropout_rate are
+# shared variables and can differ between runs using the same functions
+FUNCTION_CACHE_ARGS = ("layer", "depth", "order", "hidden_dim", "act", "mode", "decay",
+        "pooling", "precompute", "products", "final_softmax", "no_bias", "use_hier",
+        "hier_dim", "binary", "learning", "l2_reg", "sparse_emb_updates",
+        "flat_params")
+
+def function_cache_key(args, values):
+    """Hash of the model args of FUNCTION_CACHE_ARGS, the given values, the
+    Theano configuration and the sources of the model."""
+    code_files = [ inspect.getsourcefile(Model) ] + \
+            sorted(glob.glob(os.path.join(os.path.dirname(inspect.getsourcefile(Layer)), "*.py")))
+    values = [ FUNCTION_CACHE_VERSION, theano.__version__, theano.config.floatX,
+            theano.config.device, theano.config.mode, theano.config.optimizer,
+            theano.config.linker ] + \
+            [ (name, getattr(args, name, None)) for name in FUNCTION_CACHE_ARGS ] + values
+    return content_hash(code_files, values)
+
+def shared_variables(specs):
+    """Shared variables used by the theano.function kwargs of specs, in graph order,
+    including the ones only used by the default updates (e.g. of random states)."""
+    variables, seen = [ ], set()
+    for name, kwargs in specs:
+        outputs = kwargs["outputs"]
+        roots = list(outputs) if isinstance(outputs, (list, tuple)) else [ outputs ]
+        updates = kwargs.get("updates", [ ])
+        for p, v in (updates.items() if isinstance(updates, dict) else updates):
+            roots += [ p, v ]
+        while roots:
+            default_updates = [ ]
+            for v in theano.gof.graph.inputs(roots):
+                if isinstance(v, theano.compile.SharedVariable) and id(v) not in seen:
+                    seen.add(id(v))
+                    variables.append(v)
+                    if getattr(v, "default_update", None) is not None:
+                        default_updates.append(v.default_update)
+            roots = default_updates
+    return variables
+
+def save_functions(path, functions, shared):
+    """Pickle compiled functions together with the shared variables they use.
+
+    The values of the shared arrays are replaced with empty arrays while
+    pickling, as they are set again when the functions are loaded.
+    """
+    values = [ v.get_value(borrow=True) for v in shared ]
+    for v, value in zip(shared, values):
+        if isinstance(value, np.ndarray) and value.ndim > 0:
+            v.set_value(np.zeros((0,)*value.ndim, dtype=value.dtype), borrow=True)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    # theano graphs are deeply nested
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, FUNCTION_CACHE_RECURSION_LIMIT))
+    try:
+        with open(tmp_path, "wb") as fout:
+            pickle.dump((functions, shared), fout, protocol=pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+        print "Cached compiled functions:", path
+    except Exception as e:
+        say("could not cache compiled functions: {}\n".format(e))
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+        for v, value in zip(shared, values):
+            v.set_value(value, borrow=True)
+
+def load_functions(path, shared):
+    """Load functions saved by save_functions, rebound to the given shared
+    variables. Returns None if they do not match the cached ones."""
+    recursion_limit = sys.getrecursionlimit()
+    sys.setrecursionlimit(max(recursion_limit, FUNCTION_CACHE_RECURSION_LIMIT))
+    try:
+        with open(path, "rb") as fin:
+            functions, cached_shared = pickle.load(fin)
+    finally:
+        sys.setrecursionlimit(recursion_limit)
+    # random state types only compare equal to themselves, so compare their class
+    if len(cached_shared) != len(shared) or any(type(a.type) is not type(b.type) or
+            (isinstance(b.type, T.TensorType) and a.type != b.type)
+            for a, b in zip(cached_shared, shared)):
+        return None
+    used = set(v for f in functions.values() for v in f.get_shared())
+    if not used.issubset(cached_shared):
+        return None
+    for a, b in zip(cached_shared, shared):
+        # the loaded functions read and update the storage of the given
+        # variable from now on
+        a.set_value(b.get_value(borrow=True), borrow=True)
+        b.container.storage = a.container.storage
+    print "Loaded compiled functions:", path
+    return functions
+
+CHECKPOINT_SUFFIX = ".ckpt"
+CHECKPOINT_VERSION = 1
+
+def load_vocab(path):
+    """Return the words of the embedding layer saved with the model at path,
+    ordered by ID, or None for a model saved without them."""
+    for ckpt_path in (path, path + CHECKPOINT_SUFFIX):
+        manifest_path = os.path.join(ckpt_path, "manifest.json")
+        if os.path.isfile(manifest_path):
+            with open(manifest_path) as fin:
+                manifest = json.load(fin)
+            if "vocab" not in manifest:
+                return None
+            with open(os.path.join(ckpt_path, manifest["vocab"])) as fin:
+                return fin.read().split("\n")
+    if not os.path.exists(path):
+        if path.endswith(".pkl"):
+            path += ".gz"
+        else:
+            path += ".pkl.gz"
+    with gzip.open(path, "rb") as fin:
+        values = pickle.load(fin)
+    return values[3] if len(values) > 3 else None
 
 def read_corpus(path):
     with open(path) as fin:
@@ -139,8 +459,12 @@ def read_corpus(path):
     return corpus_x, corpus_y
 
 
-def create_one_batch(ids, x, y, hier):
-    batch_x = np.column_stack( [ x[i] for i in ids ] )
+def create_one_batch(ids, x, y, hier, pad_id=0):
+    # pad every sequence at the end to the longest one in the batch
+    max_len = max(len(x[i]) for i in ids)
+    batch_x = np.column_stack( [ np.pad(x[i], (0, max_len-len(x[i])), mode='constant',
+        constant_values=pad_id) for i in ids ] )
+    batch_mask = np.column_stack( [ np.arange(max_len) < len(x[i]) for i in ids ] ).astype('float32')
     batch_y = np.array( [ y[i] for i in ids ] )
     if hier is None:
         batch_hier = np.column_stack( [[] for i in ids] ).astype('float32')
@@ -148,10 +472,16 @@ def create_one_batch(ids, x, y, hier):
         batch_hier = np.column_stack( [ hier[i] for i in ids ] )
     #batch_y = y[ids]
     assert batch_x.shape[1] == batch_y.shape[0]
-    return batch_x, batch_y, batch_hier
+    return batch_x, batch_y, batch_hier, batch_mask
 
 # shuffle training examples and create mini-batches
-def create_batches(perm, x, y, hier, batch_size):
+def create_batches(perm, x, y, hier, batch_size, max_padding=0.0):
+    """Group examples of similar length into mini-batches.
+
+    Sequences of a batch are padded at the end to its longest one. A batch is
+    closed once the fraction of padded tokens would exceed max_padding, so
+    max_padding=0 only batches sequences of equal length.
+    """
 
     # sort sequences based on their length
     # permutation is necessary if we want different batches every epoch
@@ -160,24 +490,32 @@ def create_batches(perm, x, y, hier, batch_size):
     batches_x = [ ]
     batches_y = [ ]
     batches_hier = [ ]
+    batches_mask = [ ]
     size = batch_size
     ids = [ lst[0] ]
+    num_tokens = len(x[lst[0]])
     for i in lst[1:]:
-        if len(ids) < size and len(x[i]) == len(x[ids[0]]):
+        # x[i] is the longest sequence of the batch since lst is sorted
+        padding = 1.0 - (num_tokens + len(x[i])) / float((len(ids)+1) * len(x[i]))
+        if len(ids) < size and padding <= max_padding:
             ids.append(i)
+            num_tokens += len(x[i])
         else:
             #print ids
             #print x, len(x)
             #print y, len(y)
-            bx, by, bhier = create_one_batch(ids, x, y, hier)
+            bx, by, bhier, bmask = create_one_batch(ids, x, y, hier)
             batches_x.append(bx)
             batches_y.append(by)
             batches_hier.append(bhier)
+            batches_mask.append(bmask)
             ids = [ i ]
-    bx, by, bhier = create_one_batch(ids, x, y, hier)
+            num_tokens = len(x[i])
+    bx, by, bhier, bmask = create_one_batch(ids, x, y, hier)
     batches_x.append(bx)
     batches_y.append(by)
     batches_hier.append(bhier)
+    batches_mask.append(bmask)
 
     # shuffle batches
     batch_perm = range(len(batches_x))
@@ -185,8 +523,207 @@ def create_batches(perm, x, y, hier, batch_size):
     batches_x = [ batches_x[i] for i in batch_perm ]
     batches_y = [ batches_y[i] for i in batch_perm ]
     batches_hier = [ batches_hier[i] for i in batch_perm ]
-    assert len(batches_x) == len(batches_y) == len(batches_hier)
-    return batches_x, batches_y, batches_hier
+    batches_mask = [ batches_mask[i] for i in batch_perm ]
+    assert len(batches_x) == len(batches_y) == len(batches_hier) == len(batches_mask)
+    return batches_x, batches_y, batches_hier, batches_mask
+
+def group_by_length(x, max_padding=0.0, max_size=None, subsets=False):
+    """Group the non-empty sequences of x into lists of indices of similar length.
+
+    Indices are sorted by length, and a group is closed once padding its
+    sequences to the longest one would make more than max_padding of its tokens
+    padding, or once it has max_size sequences. With subsets=True the limit
+    holds for every subset of a group: a group is closed once its shortest
+    sequence alone would be more than max_padding padding, since the padding
+    of any subset is at most 1 - min_len/max_len.
+    """
+    lst = sorted([ i for i in range(len(x)) if len(x[i]) > 0 ], key=lambda i: len(x[i]))
+    groups = [ ]
+    ids = [ ]
+    num_tokens = 0
+    for i in lst:
+        # x[i] is the longest sequence of the group since lst is sorted
+        if subsets and ids:
+            padding = 1.0 - len(x[ids[0]]) / float(len(x[i]))
+        else:
+            padding = 1.0 - (num_tokens + len(x[i])) / float((len(ids)+1) * len(x[i]))
+        if ids and (padding > max_padding or len(ids) == max_size):
+            groups.append(ids)
+            ids = [ ]
+            num_tokens = 0
+        ids.append(i)
+        num_tokens += len(x[i])
+    if ids:
+        groups.append(ids)
+    return groups
+
+class BatchIndex:
+    """Length buckets of the training examples, built once and reused every epoch.
+
+    Examples are grouped by length as in create_batches, except that a bucket is
+    not limited to batch_size examples. Since a mini-batch is any batch_size
+    rows of its bucket, max_padding bounds the padding of every subset of a
+    bucket (see group_by_length), so that it holds for every mini-batch as it
+    does in create_batches. Each bucket is stored as a preallocated
+    (n, max_len) int32 token matrix together with its mask, targets and hier
+    features. Every epoch only permutes the rows of each bucket into a spare
+    buffer of the same shape and hands out slices of it as mini-batches, so the
+    batches of an epoch are views that are valid until the next call to
+    shuffle().
+    """
+    def __init__(self, x, y, hier, batch_size, max_padding=0.0, pad_id=0):
+        self.batch_size = batch_size
+        groups = group_by_length(x, max_padding, subsets=True)
+        self.buckets = [ self.create_bucket(ids, x, y, hier, pad_id) for ids in groups ]
+
+    def create_bucket(self, ids, x, y, hier, pad_id):
+        lengths = np.array([ len(x[i]) for i in ids ], dtype='int32')
+        tokens = np.empty((len(ids), lengths.max()), dtype='int32')
+        tokens.fill(pad_id)
+        for row, i in enumerate(ids):
+            tokens[row, :lengths[row]] = x[i]
+        mask = (np.arange(tokens.shape[1]) < lengths[:,None]).astype('float32')
+        bucket_y = np.array( [ y[i] for i in ids ] )
+        if hier is None:
+            bucket_hier = np.zeros((len(ids), 0), dtype='float32')
+        else:
+            bucket_hier = np.array( [ hier[i] for i in ids ] )
+        arrays = [ tokens, mask, bucket_y, bucket_hier, lengths ]
+        # order[k] is the position in ids of the example now in row k
+        return [ arrays, [ np.empty_like(a) for a in arrays ], np.arange(len(ids)) ]
+
+    def __len__(self):
+        return sum((len(bucket[0][0])-1) // self.batch_size + 1 for bucket in self.buckets)
+
+    def get_state(self):
+        """Current row order of every bucket, which the next shuffle permutes."""
+        return [ bucket[2].copy() for bucket in self.buckets ]
+
+    def set_state(self, orders):
+        assert len(orders) == len(self.buckets)
+        for bucket, order in zip(self.buckets, orders):
+            arrays, spares, current = bucket
+            perm = np.argsort(current)[order]
+            for a, spare in zip(arrays, spares):
+                np.take(a, perm, axis=0, out=spare)
+            bucket[0], bucket[1], bucket[2] = spares, arrays, np.array(order)
+
+    def shuffle(self):
+        """Return the mini-batches of a new epoch as a shuffled list of
+        (x, y, hier, mask) tuples, with x and mask of shape (len, batch)."""
+        batch_size = self.batch_size
+        batches = [ ]
+        for bucket in self.buckets:
+            arrays, spares, order = bucket
+            perm = range(len(arrays[0]))
+            random.shuffle(perm)
+            for a, spare in zip(arrays, spares):
+                np.take(a, perm, axis=0, out=spare)
+            bucket[0], bucket[1], bucket[2] = spares, arrays, order[perm]
+            tokens, mask, y, hier, lengths = spares
+            for start in range(0, len(tokens), batch_size):
+                end = start + batch_size
+                max_len = lengths[start:end].max()
+                batches.append((
+                        tokens[start:end, :max_len].T,
+                        y[start:end],
+                        hier[start:end].T,
+                        mask[start:end, :max_len].T
+                    ))
+        random.shuffle(batches)
+        return batches
+
+def prepare_batch(x, y, hier_x, mask):
+    """Make the arrays of a mini-batch contiguous and check their types."""
+    x, y, hier_x, mask = [ np.ascontiguousarray(a) for a in (x, y, hier_x, mask) ]
+    y_len = np.array([j.sum() for j in y])
+    #y = y.toarray()
+
+    assert x.dtype in ['float32', 'int32']
+    assert y.dtype in ['float32', 'int32']
+    assert hier_x.dtype in ['float32', 'int32']
+    #print x.shape
+    #print y.shape
+    #print hier_x.shape
+    return x, y, hier_x, mask, y_len
+
+class BatchPrefetcher(threading.Thread):
+    """Prepare the mini-batches of an epoch in a background thread.
+
+    At most depth prepared batches are kept in a bounded queue while the
+    compiled train function runs. wait_time is the total time spent waiting
+    for a batch on the queue.
+    """
+    def __init__(self, batches, depth):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.batches = batches
+        self.queue = Queue.Queue(maxsize=depth)
+        self.wait_time = 0.0
+
+    def run(self):
+        try:
+            for batch in self.batches:
+                self.queue.put(prepare_batch(*batch))
+        except Exception as e:
+            self.queue.put(e)
+            raise
+
+    def __iter__(self):
+        for i in xrange(len(self.batches)):
+            start_time = time.time()
+            batch = self.queue.get()
+            self.wait_time += time.time() - start_time
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+def inference_batches(x_data, hier_x, batch_size, max_padding=0.25, pad_id=0):
+    """Padded mini-batches of the non-empty articles of x_data for inference.
+
+    Yields (ids, x, mask, hier) with x and mask of shape (len, batch) and hier
+    of shape (hier_dim, batch), or (0, batch) if hier_x is None.
+    """
+    for ids in group_by_length(x_data, max_padding, batch_size):
+        lengths = np.array([ len(x_data[i]) for i in ids ])
+        batch_x = np.empty((lengths.max(), len(ids)), dtype='int32')
+        batch_x.fill(pad_id)
+        for col, i in enumerate(ids):
+            batch_x[:lengths[col], col] = x_data[i]
+        batch_mask = (np.arange(len(batch_x))[:,None] < lengths).astype('float32')
+        if hier_x is None:
+            batch_hier = np.zeros((0, len(ids)), dtype='float32')
+        else:
+            batch_hier = np.ascontiguousarray(np.asarray(hier_x)[ids].T)
+        yield ids, batch_x, batch_mask, batch_hier
+
+def predict_all(predict_model, x_data, hier_x, prod_reps, batch_size=64):
+    """Predictions for the non-empty articles of x_data, computed in batches.
+
+    prod_reps are the product representations from Model.encode_products, or
+    None without products. Returns the indices of those articles in increasing
+    order and their (n, nclasses) predictions in the same order.
+    """
+    ids, results = [ ], [ ]
+    for batch_ids, batch_x, batch_mask, batch_hier in inference_batches(
+            x_data, hier_x, batch_size):
+        if prod_reps is None:
+            results.append(predict_model(batch_x, batch_mask, batch_hier))
+        else:
+            results.append(predict_model(batch_x, batch_mask, batch_hier, prod_reps))
+        ids.extend(batch_ids)
+    if not ids:
+        return np.array(ids, dtype='int64'), np.zeros((0, 0), dtype='float32')
+    order = np.argsort(ids)
+    return np.array(ids)[order], np.vstack(results)[order]
+
+def represent_all(get_representation, x_data, n_out, batch_size=64):
+    """Representations (of size n_out) of all the articles of x_data in their
+    original order, with zero vectors for empty articles."""
+    ing_reps = np.zeros((len(x_data), n_out), dtype=theano.config.floatX)
+    for batch_ids, batch_x, batch_mask, _ in inference_batches(x_data, None, batch_size):
+        ing_reps[batch_ids] = get_representation(batch_x, batch_mask)[0]
+    return ing_reps
 
 def get_ing_split(seed):
     """Split ing into train, dev, adulterants. 
@@ -243,7 +780,8 @@ def gen_text_predictions(args, fname):
     hier_to_cat.test_model(
         results, ings, idx_to_cat, top_n=5, fname=text_fname, ings_wiki_links=get_ings_wiki_links())
 
-def save_representations(args, get_representation, train, dev, test, products):
+def save_representations(args, get_representation, n_out, train, dev, test, prod_reps):
+    batch_size = getattr(args, "eval_batch", 64)
     label = args.model
     if not label:
         label = str(int(time.time()))
@@ -254,32 +792,15 @@ def save_representations(args, get_representation, train, dev, test, products):
         if x_data is None:
             print "No data for:", data_name
             continue
-        ing_reps = []
-        prod_reps = None
-        counter = 0
-        for x_idx, x_for_predict in enumerate(x_data):
-            if len(x_for_predict) > 0:
-                counter += 1
-                if products is None:
-                    ing_rep = get_representation(np.vstack(x_for_predict))[0][0]
-                    ing_reps.append(ing_rep)
-                else:
-                    ing_rep, prod_rep = get_representation(np.vstack(x_for_predict), products)
-                    ing_reps.append(ing_rep[0])
-                    if prod_reps is None:
-                        prod_reps = prod_rep
-                    else:
-                        prod_reps += prod_rep
-            else:
-                ing_reps.append(np.zeros(len(ing_reps[0]))) # hopefully ing_reps[0] exists
+        ing_reps = represent_all(get_representation, x_data, n_out, batch_size)
         ing_fname = 'representations/{}_{}_ing_reps.npy'.format(label, data_name)
-        np.save(ing_fname, np.array(ing_reps))
-        if products is not None:
-            prod_reps /= counter
+        np.save(ing_fname, ing_reps)
+        if prod_reps is not None:
             prod_fname = 'representations/{}_{}_prod_reps.npy'.format(label, data_name)
             np.save(prod_fname, prod_reps)
 
-def save_predictions(args, predict_model, train, dev, test, hier, products):
+def save_predictions(args, predict_model, train, dev, test, hier, prod_reps):
+    batch_size = getattr(args, "eval_batch", 64)
     label = args.model
     seed = args.seed
     if not label:
@@ -293,33 +814,17 @@ def save_predictions(args, predict_model, train, dev, test, hier, products):
         if x_data is None:
             print "No data for:", data_name
             continue
-        results = []
-        for x_idx, x_for_predict in enumerate(x_data):
-            if len(x_for_predict) > 0:
-                if hier_x is not None:
-                    if products is None:
-                        p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                            np.vstack(hier_x[x_idx]))[0]
-                    else:
-                        p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                            np.vstack(hier_x[x_idx]), products)[0]
-                else:
-                    if products is None:
-                        p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                            np.column_stack([[]]))[0]
-                    else:
-                        p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                            np.column_stack([[]]), products)[0]
-                results.append(p_y_given_x)
-            else:
-                results.append(np.zeros(len(results[0])))
+        ids, p_y_given_x = predict_all(predict_model, x_data, hier_x, prod_reps, batch_size)
+        # empty articles keep zero predictions
+        results = np.zeros((len(x_data), p_y_given_x.shape[1]), dtype=p_y_given_x.dtype)
+        results[ids] = p_y_given_x
         fname = 'predictions/{}_{}_pred.npy'.format(label, data_name)
         print "Saved predictions to:", fname
-        np.save(fname, np.array(results))
+        np.save(fname, results)
         gen_text_predictions(args, fname)
 
 
-def evaluate(x_data, y_data, hier_x, products, predict_model):
+def evaluate(x_data, y_data, hier_x, prod_reps, predict_model, batch_size=64):
     """Compute the MAP of the data."""
     ing_cat_pair_map = {}
     for x_idx, x in enumerate(x_data):
@@ -327,29 +832,9 @@ def evaluate(x_data, y_data, hier_x, products, predict_model):
             if out > 0:
                 ing_cat_pair_map[(x_idx, y_idx)] = True
 
-    valid_ing_indices, results = [], []
-    for x_idx, x_for_predict in enumerate(x_data):
-        if len(x_for_predict) > 0:
-            if hier_x is not None:
-                if products is None:
-                    p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                        np.vstack(hier_x[x_idx]))[0]
-                else:
-                    p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                        np.vstack(hier_x[x_idx]), products)[0]
-            else:
-                if products is None:
-                    p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                        np.column_stack([[]]))[0]
-                else:
-                    p_y_given_x = predict_model(np.vstack(x_for_predict), 
-                        np.column_stack([[]]), products)[0]
-            valid_ing_indices.append(x_idx)
-            results.append(p_y_given_x)
-    valid_ing_indices = np.array(valid_ing_indices)
+    valid_ing_indices, results = predict_all(predict_model, x_data, hier_x, prod_reps, batch_size)
     avg_true_results = scoring.gen_avg_true_results(valid_ing_indices)
 
-    results = np.array(results)
     print "Random:"
     scoring.evaluate_map(valid_ing_indices, results, ing_cat_pair_map, random=True)
     print "Avg True Results:"
@@ -358,20 +843,26 @@ def evaluate(x_data, y_data, hier_x, products, predict_model):
     scoring.evaluate_map(valid_ing_indices, results, ing_cat_pair_map, random=False)
 
 class Model:
-    def __init__(self, args, embedding_layer, nclasses, products_len):
+    def __init__(self, args, embedding_layer, nclasses, products_len, function_cache=""):
         self.args = args
         self.embedding_layer = embedding_layer
         self.nclasses = nclasses
         self.products_len = products_len
+        self.function_cache = function_cache
 
-    def ready(self):
+    def ready(self, inference=False):
+        """Build the graph. With inference=True it is built without dropout,
+        for a model that is only used for prediction."""
         args = self.args
         embedding_layer = self.embedding_layer
         self.n_hidden = args.hidden_dim
         self.n_in = embedding_layer.n_d
+        self.inference = inference
         dropout = self.dropout = theano.shared(
                 np.float64(args.dropout_rate).astype(theano.config.floatX)
             )
+        if inference:
+            dropout = None
 
         # x is length * batch_size
         # y is batch_size * num_cats
@@ -379,7 +870,11 @@ class Model:
         #self.y = T.ivector('y')
         self.y = T.fmatrix('y')
         self.y_len = T.ivector()
+        # mask is length * batch_size; 0 at padded positions
+        self.mask = T.fmatrix('mask')
         x = self.x
+        mask = self.mask
+        lengths = T.sum(mask, axis=0)
         y = self.y
         y_len = self.y_len
         n_hidden = self.n_hidden
@@ -410,6 +905,7 @@ class Model:
             self.products = T.imatrix('products')
             products = self.products
             slices_prod = embedding_layer.forward(products.ravel())
+            self.slices_prod = slices_prod
             slices_prod = slices_prod.reshape( (products.shape[0], products.shape[1], n_in) )
             prev_output_prod = apply_dropout(slices_prod, dropout, v2=True)
             products_len = theano.shared(self.products_len.astype(theano.config.floatX))
@@ -424,7 +920,8 @@ class Model:
                 print "Layer: LSTM"
                 layer = LSTM(
                             n_in = n_hidden if i > 0 else n_in,
-                            n_out = n_hidden
+                            n_out = n_hidden,
+                            precompute = getattr(args, "precompute", 1) == 1
                         )
             elif args.layer.lower() == "strcnn":
                 print "Layer: StrCNN"
@@ -433,11 +930,22 @@ class Model:
                             n_out = n_hidden,
                             activation = activation,
                             decay = args.decay,
-                            order = args.order
+                            order = args.order,
+                            precompute = getattr(args, "precompute", 1) == 1
                         )
             elif args.layer.lower() == "rcnn":
                 print "Layer: RCNN"
                 layer = RCNN(
+                            n_in = n_hidden if i > 0 else n_in,
+                            n_out = n_hidden,
+                            activation = activation,
+                            order = args.order,
+                            mode = args.mode,
+                            precompute = getattr(args, "precompute", 1) == 1
+                        )
+            elif args.layer.lower() == "prcnn":
+                print "Layer: ParallelRCNN"
+                layer = ParallelRCNN(
                             n_in = n_hidden if i > 0 else n_in,
                             n_out = n_hidden,
                             activation = activation,
@@ -448,11 +956,12 @@ class Model:
                 raise Exception("unknown layer type: {}".format(args.layer))
 
             layers.append(layer)
-            prev_output = layer.forward_all(prev_output)
+            prev_output = layer.forward_all(prev_output, mask=mask)
             if pooling:
                 softmax_inputs.append(T.sum(prev_output, axis=0)) # summing over columns
             else:
-                softmax_inputs.append(prev_output[-1])
+                # last valid position of each sequence
+                softmax_inputs.append(prev_output[T.cast(lengths, 'int32')-1, T.arange(x.shape[1])])
             prev_output = apply_dropout(prev_output, dropout)
             size += n_hidden
 
@@ -474,7 +983,7 @@ class Model:
 
         # final feature representation is the concatenation of all extraction layers
         if pooling:
-            softmax_input = T.concatenate(softmax_inputs, axis=1) / x.shape[0]
+            softmax_input = T.concatenate(softmax_inputs, axis=1) / lengths.dimshuffle((0,'x'))
         else:
             softmax_input = T.concatenate(softmax_inputs, axis=1)
         softmax_input = apply_dropout(softmax_input, dropout, v2=True)
@@ -511,6 +1020,7 @@ class Model:
             b = theano.shared(b_vals, name="b")
             softmax_input = softmax_input + b
         self.softmax_input = softmax_input
+        self.n_out = size
         # unnormalized score of y given x
         if args.products:
             if not args.no_bias:
@@ -520,6 +1030,8 @@ class Model:
                 softmax_inputs_prod = softmax_inputs_prod + b_prod#.reshape((-1,1)) # add reshape if broadcasting 
             softmax_input = T.dot(softmax_input, softmax_inputs_prod.T)
             self.softmax_inputs_prod = softmax_inputs_prod
+            # (nclasses, size_prod) product representations, encoded once per pass
+            self.prod_reps = T.matrix('prod_reps')
         #else:
             #self.softmax_inputs_prod = layers[-1].W
         
@@ -533,6 +1045,10 @@ class Model:
                 self.p_y_given_x = softmax(softmax_input)
         
         self.pred = T.argmax(self.p_y_given_x, axis=1)
+        if args.products:
+            # same prediction, scoring against the given product representations
+            self.p_y_given_x_cached = theano.clone(self.p_y_given_x,
+                    replace = { self.softmax_inputs_prod: self.prod_reps })
 
         
         if args.binary:
@@ -559,14 +1075,53 @@ class Model:
             else:
                 self.l2_sqr += args.l2_reg * T.sum(p**2)
 
+        # the word vectors are trained too with sparse_emb_updates (see
+        # sparse_embeddings()) and saved with the other parameters
+        if getattr(args, "sparse_emb_updates", 0):
+            self.params.append(embedding_layer.embeddings)
+
         nparams = sum(len(x.get_value(borrow=True).ravel()) \
                         for x in self.params)
         say("total # parameters: {}\n".format(nparams))
 
-    def save_model(self, path, args):
+    def sparse_embeddings(self):
+        """Fetch the word vectors of the batch through the rows of its unique IDs.
+        Returns the replacements of the word vector lookups for theano.clone and
+        the rows as the embedding parameter, so that the optimizer only updates
+        the vectors (and accumulators) of the words in the batch.
+        """
+        ids = [ self.x.ravel() ]
+        slices = [ self.slices ]
+        if self.args.products:
+            ids.append(self.products.ravel())
+            slices.append(self.slices_prod)
+        vectors, params = self.embedding_layer.forward_rows(T.concatenate(ids))
+        replace = { }
+        start = 0
+        for x, v in zip(ids, slices):
+            replace[v] = vectors[start:start+x.shape[0]]
+            start = start + x.shape[0]
+        return replace, params
+
+    def vocab_words(self):
+        """Words of the embedding layer ordered by their ID."""
+        vocab_map = self.embedding_layer.vocab_map
+        return sorted(vocab_map, key=vocab_map.get)
+
+    def check_vocab(self, vocab):
+        """Check that the word IDs of the embedding layer are those of the
+        saved vocab, so that the saved parameters (the word vectors with
+        sparse_emb_updates in particular) are read against the right words."""
+        assert vocab == self.vocab_words(), \
+                "Vocabulary differs from the one saved with the model"
+
+    def save_model(self, path, args, training_state=None):
         # append file suffix
         if not path:
             path = str(int(time.time()))
+        if getattr(args, "model_format", "npy") == "npy":
+            self.save_checkpoint(path, args, training_state)
+            return
         if not path.endswith(".pkl.gz"):
             if path.endswith(".pkl"):
                 path += ".gz"
@@ -575,13 +1130,120 @@ class Model:
 
         with gzip.open(path, "wb") as fout:
             pickle.dump(
-                ([ x.get_value() for x in self.params ], args, self.nclasses),
+                ([ x.get_value() for x in self.params ], args, self.nclasses,
+                    self.vocab_words()),
                 fout,
                 protocol = pickle.HIGHEST_PROTOCOL
             )
         print "Saved model:", path
 
-    def load_model(self, path):
+    def save_checkpoint(self, path, args, training_state=None):
+        """Save the model as a directory holding one .npy file per parameter,
+        the words of the embedding layer in vocab.txt, and a JSON manifest of
+        the args, nclasses and parameters.
+
+        training_state is a dict of the state needed to resume training: the
+        optimizer state arrays under "optimizer", the epoch to continue from
+        under "epoch", and picklable values (RNG states, ...) otherwise.
+        """
+        if not path.endswith(CHECKPOINT_SUFFIX):
+            path += CHECKPOINT_SUFFIX
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        os.makedirs(tmp_path)
+        params = [ ]
+        for i, x in enumerate(self.params):
+            value = x.get_value(borrow=True)
+            fname = "param_{:03d}.npy".format(i)
+            np.save(os.path.join(tmp_path, fname), value)
+            params.append({ "file": fname, "name": x.name,
+                    "shape": list(value.shape), "dtype": str(value.dtype) })
+        with open(os.path.join(tmp_path, "vocab.txt"), "w") as fout:
+            fout.write("\n".join(self.vocab_words()))
+        manifest = {
+                "version": CHECKPOINT_VERSION,
+                "nclasses": int(self.nclasses),
+                "args": vars(args),
+                "params": params,
+                "vocab": "vocab.txt"
+            }
+        if training_state is not None:
+            training_state = dict(training_state)
+            manifest["optimizer"] = [ ]
+            for i, value in enumerate(training_state.pop("optimizer")):
+                fname = "optimizer_{:03d}.npy".format(i)
+                np.save(os.path.join(tmp_path, fname), value)
+                manifest["optimizer"].append(fname)
+            manifest["epoch"] = training_state["epoch"]
+            with open(os.path.join(tmp_path, "training_state.pkl"), "wb") as fout:
+                pickle.dump(training_state, fout, protocol=pickle.HIGHEST_PROTOCOL)
+        with open(os.path.join(tmp_path, "manifest.json"), "w") as fout:
+            json.dump(manifest, fout, indent=2, sort_keys=True)
+        # replace the previous checkpoint only once the new one is complete
+        if os.path.isdir(path):
+            old_path = tmp_path + ".old"
+            os.rename(path, old_path)
+            os.rename(tmp_path, path)
+            shutil.rmtree(old_path)
+        else:
+            os.rename(tmp_path, path)
+        print "Saved model:", path
+
+    def load_checkpoint(self, path, inference=False):
+        """Load a checkpoint of save_checkpoint. The parameters are memory-mapped,
+        read-only for inference and copy-on-write otherwise."""
+        with open(os.path.join(path, "manifest.json")) as fin:
+            manifest = json.load(fin)
+        assert manifest["version"] == CHECKPOINT_VERSION
+        args = dict((str(k), str(v) if isinstance(v, unicode) else v)
+                for k, v in manifest["args"].items())
+        self.args = argparse.Namespace(**args)
+        self.nclasses = manifest["nclasses"]
+        self.ready(inference)
+        self.load_params(path, manifest, "r" if inference else "c")
+        print "Loaded model:", path
+
+    def load_params(self, path, manifest, mmap_mode):
+        if "vocab" in manifest:
+            self.check_vocab(load_vocab(path))
+        assert len(self.params) == len(manifest["params"])
+        for x, p in zip(self.params, manifest["params"]):
+            v = np.load(os.path.join(path, p["file"]), mmap_mode=mmap_mode)
+            assert v.shape == x.get_value(borrow=True).shape, (p["name"], v.shape)
+            x.set_value(v, borrow=True)
+
+    def restore_training_state(self, path, optimizer_state, rng_states, batch_index):
+        """Restore the parameters, optimizer state, RNG states and batch order
+        saved in the checkpoint at path. Returns the saved training state, or
+        None if there is no checkpoint with training state."""
+        if not path.endswith(CHECKPOINT_SUFFIX):
+            path += CHECKPOINT_SUFFIX
+        manifest_path = os.path.join(path, "manifest.json")
+        if not os.path.isfile(manifest_path):
+            return None
+        with open(manifest_path) as fin:
+            manifest = json.load(fin)
+        if "optimizer" not in manifest:
+            return None
+        self.load_params(path, manifest, "c")
+        assert len(optimizer_state) == len(manifest["optimizer"])
+        for x, fname in zip(optimizer_state, manifest["optimizer"]):
+            v = np.load(os.path.join(path, fname), mmap_mode="c")
+            assert v.shape == x.get_value(borrow=True).shape, (fname, v.shape)
+            x.set_value(v, borrow=True)
+        with open(os.path.join(path, "training_state.pkl"), "rb") as fin:
+            state = pickle.load(fin)
+        assert len(rng_states) == len(state["theano_rng"])
+        for x, v in zip(rng_states, state["theano_rng"]):
+            x.set_value(v)
+        batch_index.set_state(state["batches"])
+        random.setstate(state["random"])
+        print "Resumed from:", path
+        return state
+
+    def load_model(self, path, inference=False):
+        for ckpt_path in (path, path + CHECKPOINT_SUFFIX):
+            if os.path.isfile(os.path.join(ckpt_path, "manifest.json")):
+                return self.load_checkpoint(ckpt_path, inference)
         if not os.path.exists(path):
             if path.endswith(".pkl"):
                 path += ".gz"
@@ -589,11 +1251,14 @@ class Model:
                 path += ".pkl.gz"
 
         with gzip.open(path, "rb") as fin:
-            param_values, args, nclasses = pickle.load(fin)
+            values = pickle.load(fin)
+        param_values, args, nclasses = values[:3]
+        if len(values) > 3:
+            self.check_vocab(values[3])
 
         self.args = args
         self.nclasses = nclasses
-        self.ready()
+        self.ready(inference)
         for x,v in zip(self.params, param_values):
             x.set_value(v)
         print "Loaded model:", path
@@ -604,11 +1269,69 @@ class Model:
         return fine/fine_tot
 
 
+    def compile_functions(self, specs):
+        """Compile the functions of specs, a list of (name, theano.function
+        kwargs). With a function cache directory, the compiled functions are
+        cached under a key of the model configuration and reused with the
+        shared variables (parameters, optimizer state) of this model."""
+        if not self.function_cache:
+            return OrderedDict((name, theano.function(**kwargs)) for name, kwargs in specs)
+        shared = shared_variables(specs)
+        key = function_cache_key(self.args, [ self.inference, [ name for name, _ in specs ],
+                self.n_in, self.nclasses, self.embedding_layer.init_end,
+                None if self.products_len is None else list(self.products_len) ])
+        path = os.path.join(self.function_cache, key + ".pkl")
+        if os.path.isfile(path):
+            functions = load_functions(path, shared)
+            if functions is not None:
+                return functions
+        functions = OrderedDict((name, theano.function(**kwargs)) for name, kwargs in specs)
+        if not os.path.isdir(self.function_cache):
+            os.makedirs(self.function_cache)
+        save_functions(path, functions, shared)
+        return functions
+
+    def inference_specs(self, use_products):
+        if use_products:
+            predict_inputs = [self.x, self.mask, self.hier, self.prod_reps]
+            p_y_given_x = self.p_y_given_x_cached
+        else:
+            predict_inputs = [self.x, self.mask, self.hier]
+            p_y_given_x = self.p_y_given_x
+        specs = [ ("predict_model", dict(
+             inputs = predict_inputs,
+             outputs = p_y_given_x,
+             allow_input_downcast = True
+        )), ("get_representation", dict(
+             inputs = [self.x, self.mask],
+             outputs = [self.softmax_input],
+             allow_input_downcast = True
+        )) ]
+        if use_products:
+            specs.append(("encode_products", dict(
+                 inputs = [self.products],
+                 outputs = self.softmax_inputs_prod,
+                 givens = { } if self.inference else \
+                         { self.dropout: T.constant(np.float64(0.0).astype(theano.config.floatX)) },
+                 allow_input_downcast = True
+            )))
+        return specs
+
+    def compile_inference(self, use_products):
+        """Compile predict_model and get_representation, and encode_products
+        when using products. This is all a model loaded for scoring needs."""
+        functions = self.compile_functions(self.inference_specs(use_products))
+        self.encode_products = functions.get("encode_products")
+        return functions["predict_model"], functions["get_representation"]
+
     def train(self, train, dev, test, hier, products):
         args = self.args
         trainx, trainy = train
         train_hier_x, dev_hier_x, test_hier_x = hier
         batch_size = args.batch
+        max_padding = getattr(args, "max_padding", 0.0)
+        prefetch = getattr(args, "prefetch", 0)
+        eval_batch = getattr(args, "eval_batch", 64)
 
         #if products is None:
         #    products = [[] for i in range(131)]
@@ -617,60 +1340,78 @@ class Model:
         blank_product_hier = np.column_stack( [[] for i in range(self.nclasses)] )
 
         if dev:
-            dev_batches_x, dev_batches_y, dev_batches_hier = create_batches(
+            dev_batches_x, dev_batches_y, dev_batches_hier, dev_batches_mask = create_batches(
                     range(len(dev[0])),
                     dev[0],
                     dev[1],
                     dev_hier_x,
-                    batch_size
+                    batch_size,
+                    max_padding
             )
 
         if test:
-            test_batches_x, test_batches_y, test_batches_hier = create_batches(
+            test_batches_x, test_batches_y, test_batches_hier, test_batches_mask = create_batches(
                     range(len(test[0])),
                     test[0],
                     test[1],
                     test_hier_x,
-                    batch_size
+                    batch_size,
+                    max_padding
             )
 
         cost = self.nll_loss + self.l2_sqr
+        params = self.params
+        replace = { }
+        emb_params = [ ]
+        if getattr(args, "sparse_emb_updates", 0):
+            params = self.params[:-1]
+            emb_replace, emb_params = self.sparse_embeddings()
+            replace.update(emb_replace)
+        flat_params = None
+        if getattr(args, "flat_params", 0):
+            # the graphs use views of one flat vector instead of the params
+            flat_params = FlatParams(params)
+            replace.update(flat_params.views)
+            params = [ flat_params.flat ]
+        if replace:
+            cost = theano.clone(cost, replace=replace)
+        for p in emb_params:
+            cost += args.l2_reg * T.sum(p**2)
+        params = params + emb_params
 
         updates, lr, gnorm = create_optimization_updates(
                 cost = cost,
-                params = self.params,
+                params = params,
                 lr = args.learning_rate,
                 method = args.learning
             )[:3]
         if products is not None:
-            inputs = [self.x, self.y, self.hier, self.products]
-            predict_inputs = [self.x, self.hier, self.products]
+            inputs = [self.x, self.mask, self.y, self.hier, self.products]
+            eval_inputs = [self.x, self.mask, self.hier, self.products]
         else:
-            inputs = [self.x, self.y, self.hier]
-            predict_inputs = [self.x, self.hier]
-        train_model = theano.function(
+            inputs = [self.x, self.mask, self.y, self.hier]
+            eval_inputs = [self.x, self.mask, self.hier]
+        specs = [ ("train_model", dict(
              inputs = inputs,
              outputs = [ cost, gnorm ],
              updates = updates,
              allow_input_downcast = True
-        )
-        predict_model = theano.function(
-             inputs = predict_inputs,
-             outputs = self.p_y_given_x,
-             allow_input_downcast = True
-        )
-        get_representation = theano.function(
-             inputs = [self.x, self.products] if products is not None else [self.x],
-             outputs = [self.softmax_input, self.softmax_inputs_prod] if products is not None else [self.softmax_input],
-             allow_input_downcast = True
-        )
-        eval_acc = theano.function(
-             inputs = predict_inputs,
+        )) ] + self.inference_specs(products is not None) + [ ("eval_acc", dict(
+             inputs = eval_inputs,
              outputs = self.pred,
              allow_input_downcast = True
-        )
-        if args.load_model:
-            return predict_model, get_representation
+        )) ]
+        if flat_params is not None:
+            for name, kwargs in specs[1:]:
+                kwargs["outputs"] = flat_params.replace(kwargs["outputs"])
+        functions = self.compile_functions(specs)
+        optimizer_state = get_optimizer_state(updates, params)
+        rng_states = [ v for v in shared_variables(specs) if not isinstance(v.type, T.TensorType) ]
+        train_model = functions["train_model"]
+        predict_model = functions["predict_model"]
+        get_representation = functions["get_representation"]
+        eval_acc = functions["eval_acc"]
+        self.encode_products = functions.get("encode_products")
         unchanged = 0
         best_dev = 0.0
         dropout_prob = np.float64(args.dropout_rate).astype(theano.config.floatX)
@@ -678,45 +1419,47 @@ class Model:
         start_time = time.time()
         eval_period = args.eval_period
 
-        perm = range(len(trainx))
+        train_batches = BatchIndex(trainx, trainy, train_hier_x, batch_size, max_padding)
+
+        start_epoch = 0
+        if getattr(args, "resume", False):
+            state = self.restore_training_state(args.model, optimizer_state, rng_states, train_batches)
+            if state is None:
+                say("no checkpoint to resume from, starting from scratch\n")
+            else:
+                start_epoch, unchanged, best_dev = state["epoch"], state["unchanged"], state["best_dev"]
+                if flat_params is not None:
+                    flat_params.pack()
+                say("resuming at epoch {}\n".format(start_epoch+1))
 
         say(str([ "%.2f" % np.linalg.norm(x.get_value(borrow=True)) for x in self.params ])+"\n")
-        for epoch in xrange(args.max_epochs):
+        for epoch in xrange(start_epoch, args.max_epochs):
             unchanged += 1
             #if dev and unchanged > 30: return
             train_loss = 0.0
 
-            random.shuffle(perm)
-            batches_x, batches_y, batches_hier = create_batches(
-                perm, trainx, trainy, train_hier_x, batch_size)
-            N = len(batches_x)
+            batches = train_batches.shuffle()
+            N = len(batches)
+            if prefetch > 0:
+                batch_iter = BatchPrefetcher(batches, prefetch)
+                batch_iter.start()
+            else:
+                batch_iter = (prepare_batch(*batch) for batch in batches)
 
             blah = None#Delete me
 
-            for i in xrange(N):
+            for i, (x, y, hier_x, mask, y_len) in enumerate(batch_iter):
 
                 if i % 100 == 0:
                     sys.stdout.write("\r%d" % i)
                     sys.stdout.flush()
 
-                x = batches_x[i]
-                y = batches_y[i]
-                hier_x = batches_hier[i]
-                y_len = np.array([j.sum() for j in batches_y[i]])
-                #y = y.toarray()
-
-                assert x.dtype in ['float32', 'int32']
-                assert y.dtype in ['float32', 'int32']
-                assert hier_x.dtype in ['float32', 'int32']
-                #print x.shape
-                #print y.shape
-                #print hier_x.shape
                 if products is not None:
                     #print products.shape
                     assert products.dtype in ['float32', 'int32']
-                    va, grad_norm = train_model(x, y, hier_x, products)
+                    va, grad_norm = train_model(x, mask, y, hier_x, products)
                 else:
-                    va, grad_norm = train_model(x, y, hier_x)
+                    va, grad_norm = train_model(x, mask, y, hier_x)
                 train_loss += va
                 
                 #if products is not None:
@@ -741,6 +1484,10 @@ class Model:
                             float(grad_norm),
                             (time.time()-start_time) / 60.0
                     ))
+                    if prefetch > 0:
+                        say( "\tbatch queue wait=%.2fs\n" % batch_iter.wait_time )
+                    if flat_params is not None:
+                        flat_params.unpack()
                     say(str([ "%.2f" % np.linalg.norm(x.get_value(borrow=True)) for x in self.params ])+"\n")
 
                     """
@@ -779,20 +1526,33 @@ class Model:
             #        print x_idx, p_y_given_x
             if epoch == 0 or (epoch+1) % 10 == 0 or epoch == args.max_epochs-1:
                 evaluate_start_time = time.time()
+                prod_reps = self.encode_products(products) if products is not None else None
                 print "\nEpoch:", epoch+1
                 print "======= Training evaluation ========"
-                evaluate(trainx, trainy, train_hier_x, products, predict_model)
+                evaluate(trainx, trainy, train_hier_x, prod_reps, predict_model, eval_batch)
                 if dev:
                     print "======= Validation evaluation ========"
-                    evaluate(dev[0], dev[1], dev_hier_x, products, predict_model)
+                    evaluate(dev[0], dev[1], dev_hier_x, prod_reps, predict_model, eval_batch)
                 if test:
                     print "======= Adulteration evaluation ========"
-                    evaluate(test[0], test[1], test_hier_x, products, predict_model)
+                    evaluate(test[0], test[1], test_hier_x, prod_reps, predict_model, eval_batch)
                 print "Evaluate time: {:.1f}m".format((time.time()-evaluate_start_time)/60)
                 start_time = time.time()
                 if args.save_model:
-                    self.save_model(args.model, args)
+                    if flat_params is not None:
+                        flat_params.unpack()
+                    self.save_model(args.model, args, training_state = dict(
+                            epoch = epoch + 1,
+                            unchanged = unchanged,
+                            best_dev = best_dev,
+                            optimizer = [ v.get_value(borrow=True) for v in optimizer_state ],
+                            batches = train_batches.get_state(),
+                            random = random.getstate(),
+                            theano_rng = [ v.get_value() for v in rng_states ],
+                        ))
                 start_time = time.time()
+        if flat_params is not None:
+            flat_params.unpack()
         return predict_model, get_representation
 
 def main(args):
@@ -805,44 +1565,31 @@ def main(args):
     assert args.embedding, "Pre-trained word embeddings required."
     assert not (args.products and args.use_hier and not args.final_softmax), "Hier won't be used here."
     assert args.train or (args.load_model and args.test), "Need training data or existing model"
-
-    print "Loading embeddings"
-    if '.pkl' in args.embedding:
-        with open(args.embedding, 'rb') as f:
-            embedding = pickle.load(f)
-            if '<unk>' not in embedding:
-                embedding['<unk>'] = np.zeros(len(embedding['</s>']))
-    else:
-        embedding = load_embedding_iterator(args.embedding)
-
-    embedding_layer = EmbeddingLayer(
-                n_d = args.hidden_dim,
-                vocab = [ "<unk>" ],
-                embs = embedding       
-            )
+    assert not args.resume or (args.model and args.model_format == "npy"), \
+            "Resuming needs the --model label of a checkpoint saved with --model_format npy"
 
     print "Reading corpus"
     products, products_len = None, None
     if args.products:
         products_text, products_len = read_corpus_products()
-        products = [ embedding_layer.map_to_ids(x) for x in products_text ]
-        products = np.column_stack(products)
 
     train_hier_x = dev_hier_x = test_hier_x = None
     if args.train:
-        data_x_text, data_y, data_hier_x = read_corpus_ingredients()
+        data_x_text, data_y, data_hier_x = load_ingredients(args.corpus_cache)
         print "# Ings:", len(data_x_text)
         if args.add_adulterants:
-            test_x_text, test_y, test_hier_x = read_corpus_adulterants()
+            test_x_text, test_y, test_hier_x = load_adulterants(args.corpus_cache)
             print "# Adulterants:", len(test_x_text)
             assert len(test_x_text) == len(adulterants)
-            data_x_text = np.array(list(data_x_text) + list(test_x_text))
+            data_x_text = data_x_text.concatenate(test_x_text)
             data_y = np.array(list(data_y) + list(test_y)).astype('float32')
-            data_hier_x = np.array(list(data_hier_x) + list(test_hier_x)).astype('float32')
+            data_hier_x = scipy.sparse.vstack([ data_hier_x, test_hier_x ]).tocsr()
             ings = np.hstack([ings, adulterants])
         if args.binary:
             data_y = convert_to_zero_one(data_y)
-        data_hier_x = reduce_dim(data_hier_x, args.hier_dim)
+        train_hier_raw = data_hier_x
+        if args.use_hier:
+            data_hier_x = reduce_dim(data_hier_x, args.hier_dim)
         #print "Num data points:", len(data_x_text)
         if args.dev or args.test:
             #train_indices, dev_indices = train_test_split(
@@ -856,25 +1603,74 @@ def main(args):
             train_x_text = data_x_text[train_indices]
             dev_y = data_y[dev_indices]
             train_y = data_y[train_indices]
-            if len(data_hier_x) > 0:
+            if data_hier_x.shape[0] > 0:
                 if not args.test_adulterants_only:
                     test_hier_x = data_hier_x[test_indices]
                 dev_hier_x = data_hier_x[dev_indices]
                 train_hier_x = data_hier_x[train_indices]
-        train_x = [ embedding_layer.map_to_ids(x) for x in train_x_text ]
-    
-    if args.dev:
-        #dev_x, dev_y = read_corpus(args.dev)
-        dev_x = [ embedding_layer.map_to_ids(x) for x in dev_x_text ]
 
     if args.test_adulterants_only:
-        test_x_text, test_y, test_hier_x = read_corpus_adulterants()
+        test_x_text, test_y, test_hier_x = load_adulterants(args.corpus_cache)
         if args.binary:
             test_y = convert_to_zero_one(test_y)
-        test_hier_x = reduce_dim(test_hier_x, args.hier_dim)
-    
+        if args.use_hier:
+            # project with the components of the training ingredients
+            if not args.train:
+                train_hier_raw = load_ingredients(args.corpus_cache)[2]
+                if args.add_adulterants:
+                    train_hier_raw = scipy.sparse.vstack([ train_hier_raw, test_hier_x ]).tocsr()
+            test_hier_x = reduce_dim(test_hier_x, args.hier_dim, fit_x=train_hier_raw)
+
+    corpus_vocab = None
+    saved_vocab = load_vocab(args.load_model) if args.load_model else None
+    if saved_vocab is not None:
+        # rebuild the vocabulary the model was trained with
+        corpus_vocab = set(saved_vocab)
+    elif args.prune_vocab:
+        corpus_vocab = set([ "<unk>" ])
+        if args.products:
+            corpus_vocab.update(token for x in products_text for token in x)
+        if args.train:
+            corpus_vocab.update(data_x_text.words)
+        if args.test:
+            corpus_vocab.update(test_x_text.words)
+    print "Loading embeddings"
+    if args.embedding.endswith('.npy'):
+        embedding = load_embedding_matrix(args.embedding)
+    elif '.pkl' in args.embedding:
+        with open(args.embedding, 'rb') as f:
+            embedding = pickle.load(f)
+            if '<unk>' not in embedding:
+                embedding['<unk>'] = np.zeros(len(embedding['</s>']))
+        if args.convert_embedding:
+            save_embedding_matrix(args.convert_embedding, embedding.keys(), embedding.values())
+            embedding = load_embedding_matrix(args.convert_embedding)
+    elif args.convert_embedding:
+        embedding = convert_embedding_file(args.embedding, args.convert_embedding)
+    else:
+        embedding = load_embedding_iterator(args.embedding)
+
+    embedding_layer = EmbeddingLayer(
+                n_d = args.hidden_dim,
+                vocab = [ "<unk>" ],
+                embs = embedding if corpus_vocab is None else \
+                        filter_embeddings(embedding, corpus_vocab),
+                fix_init_embs = args.fix_init_embs == 1
+            )
+
+    if args.products:
+        products = [ embedding_layer.map_to_ids(x) for x in products_text ]
+        products = np.column_stack(products)
+
+    if args.train:
+        train_x = train_x_text.map_to_ids(embedding_layer)
+
+    if args.dev:
+        #dev_x, dev_y = read_corpus(args.dev)
+        dev_x = dev_x_text.map_to_ids(embedding_layer)
+
     if args.test:
-        test_x = [ embedding_layer.map_to_ids(x) for x in test_x_text ]
+        test_x = test_x_text.map_to_ids(embedding_layer)
 
     if not args.use_hier:
         hier = (None, None, None)
@@ -889,25 +1685,29 @@ def main(args):
         model = Model(
                     args = None,
                     embedding_layer = embedding_layer,
-                    nclasses = -1
+                    nclasses = -1,
+                    products_len = products_len,
+                    function_cache = args.function_cache,
             )
-        model.load_model(args.load_model)
-        predict_model, get_representation = model.train(train, dev, test, hier, products)
+        model.load_model(args.load_model, inference=True)
+        predict_model, get_representation = model.compile_inference(products is not None)
     elif args.train:
         model = Model(
                     args = args,
                     embedding_layer = embedding_layer,
                     nclasses = len(train_y[0]), #max(train_y.data)+1
                     products_len = products_len,
+                    function_cache = args.function_cache,
             )
         model.ready()
         #print train_x[0].dtype, train_hier_x[0].dtype, dev_hier_x[0].dtype, test_hier_x[0].dtype
         predict_model, get_representation = model.train(
             train, dev, test, hier, products)
+    prod_reps = model.encode_products(products) if products is not None else None
     print "Saving predictions"
-    save_predictions(args, predict_model, train, dev, test, hier, products)
+    save_predictions(args, predict_model, train, dev, test, hier, prod_reps)
     print "Saving representations"
-    save_representations(args, get_representation, train, dev, test, products)
+    save_representations(args, get_representation, model.n_out, train, dev, test, prod_reps)
 
 
 if __name__ == "__main__":
@@ -967,13 +1767,63 @@ if __name__ == "__main__":
         )
     argparser.add_argument("--embedding",
             type = str,
-            default = ""
+            default = "",
+            help = "pre-trained word embeddings (.txt/.gz, .pkl dict, or .npy converted with --convert_embedding)"
+        )
+    argparser.add_argument("--prune_vocab",
+            action='store_true',
+            help = "only keep the pre-trained embeddings of words in the corpora (a loaded model always uses the vocabulary saved with it)"
+        )
+    argparser.add_argument("--sparse_emb_updates",
+            type = int,
+            default = 0,
+            help = "also train the word vectors, updating only the rows of the words in each batch"
+        )
+    argparser.add_argument("--fix_init_embs",
+            type = int,
+            default = 1,
+            help = "keep the pre-trained word vectors fixed with --sparse_emb_updates (0: train all of them)"
+        )
+    argparser.add_argument("--flat_params",
+            type = int,
+            default = 0,
+            help = "train the parameters as one flat vector (fewer, larger update ops per step)"
+        )
+    argparser.add_argument("--corpus_cache",
+            type = str,
+            default = "corpus_cache",
+            help = "directory of the tokenized corpora, keyed by a hash of their inputs (empty: no cache)"
+        )
+    argparser.add_argument("--function_cache",
+            type = str,
+            default = "",
+            help = "directory to cache the compiled Theano functions in, keyed by the model configuration (empty: no cache)"
+        )
+    argparser.add_argument("--convert_embedding",
+            type = str,
+            default = "",
+            help = "convert --embedding to a binary .npy matrix (plus .vocab file) at this path and use it"
         )
     argparser.add_argument("--batch",
             type = int,
             default = 15,
             help = "mini-batch size"
         )
+    argparser.add_argument("--max_padding",
+            type = float,
+            default = 0.0,
+            help = "max fraction of padded tokens in a mini-batch (0: only batch articles of equal length)"
+        )
+    argparser.add_argument("--prefetch",
+            type = int,
+            default = 0,
+            help = "number of mini-batches prepared ahead in a background thread (0: no prefetching)"
+        )
+    argparser.add_argument("--eval_batch",
+            type = int,
+            default = 64,
+            help = "mini-batch size of evaluation and of saving predictions/representations"
+        )
     argparser.add_argument("--depth",
             type = int,
             default = 3,
@@ -992,12 +1842,17 @@ if __name__ == "__main__":
     argparser.add_argument("--layer",
             type = str,
             default = "rcnn",
-            help = "type of neural net (LSTM, RCNN, StrCNN)"
+            help = "type of neural net (LSTM, RCNN, PRCNN, StrCNN); PRCNN is RCNN with input-only gates evaluated by parallel scan"
         )
     argparser.add_argument("--mode",
             type = int,
             default = 1
         )
+    argparser.add_argument("--precompute",
+            type = int,
+            default = 1,
+            help = "whether to compute the input projections of RCNN/LSTM outside the recurrent loop, and StrCNN without scan"
+        )
     argparser.add_argument("--seed",
             type = int,
             default = 42,
@@ -1012,10 +1867,19 @@ if __name__ == "__main__":
             action='store_true',
             help = "whether to save model"
         )
+    argparser.add_argument("--model_format",
+            type = str,
+            default = "npy",
+            help = "format of saved models: npy (directory of .npy files and manifest.json) or pkl (gzip pickle)"
+        )
+    argparser.add_argument("--resume",
+            action='store_true',
+            help = "resume training from the checkpoint of --model, with its optimizer and RNG states"
+        )
     argparser.add_argument("--load_model",
             type = str,
             default = "",
-            help = "load model from this file"
+            help = "load model from this checkpoint (.ckpt directory) or .pkl.gz file"
         )
     argparser.add_argument("--pooling",
             type = int,
@@ -1,15 +1,18 @@
 import argparse
 import itertools
+import multiprocessing
 import numpy as np
 import cPickle as pickle
 import matplotlib
 matplotlib.use('agg')
 import matplotlib.pyplot as plt
 import os
+from multiprocessing.pool import ThreadPool
 from scipy import optimize
 from sklearn.cross_validation import train_test_split
 import sys
 import time
+from StringIO import StringIO
 
 sys.path.append('../')
 from main import get_ing_split, convert_to_zero_one
@@ -95,8 +98,8 @@ def softmax(w):
 def p_y_given_x(a, b, binary, w=None):
     f = sigmoid if binary else softmax 
     if w is not None:
-        w = np.diag(w)
-        return f(np.dot(np.dot(a, w), b))
+        # a diag(w) b
+        return f(np.dot(a * w, b))
     else:
         return f(np.dot(a, b))
 
@@ -194,32 +197,254 @@ def run_naive_online(reps, reps_prod, binary, sequence, multiplier):
             assert abs(pred.sum()-1) < 1e-3
     return np.mean(losses), pred
 
+def newton_minimize(fun, w0, lower_bound=None, upper_bound=None, tol=None, maxiter=None):
+    """Projected Newton method for a convex loss with box bounds.
+
+    Input:
+        fun - fun(w, hessian=True) returns the loss, its gradient and Hessian at w,
+            the Hessian as a pair (B, l2_reg) for B.T B + l2_reg I. fun(w) only
+            needs to return the loss first.
+        w0 - starting point, e.g. the solution of a similar problem (warm start).
+        lower_bound, upper_bound - bounds of all coordinates of w (None: unbounded).
+        tol - stop when the largest projected gradient coordinate is below tol.
+        maxiter - max number of Newton steps.
+    Output:
+        optimize.OptimizeResult with x, fun, jac, nit and success, like optimize.minimize.
+    """
+    lower = -np.inf if lower_bound is None else lower_bound
+    upper = np.inf if upper_bound is None else upper_bound
+    tol = 1e-6 if tol is None else tol
+    maxiter = 100 if maxiter is None else maxiter
+    w = np.clip(np.array(w0, dtype=float), lower, upper)
+    loss, grad, hess = fun(w, hessian=True)
+    success = False
+    for nit in range(maxiter+1):
+        # coordinates at a bound that the gradient pushes out stay fixed
+        fixed = ((w <= lower) & (grad > 0)) | ((w >= upper) & (grad < 0))
+        free = ~fixed
+        if not free.any() or np.abs(grad[free]).max() < tol:
+            success = True
+            break
+        if nit == maxiter:
+            break
+        B, l2_reg = hess
+        B, g = B[:, free], grad[free]
+        step = np.zeros_like(w)
+        if l2_reg > 0 and B.shape[0] < B.shape[1]:
+            # fewer observations than dimensions: solve in the observation space
+            # (l2 I + B'B)^-1 g = (g - B' (l2 I + BB')^-1 B g) / l2
+            inner = B.dot(B.T)
+            inner[np.diag_indices_from(inner)] += l2_reg
+            step[free] = (g - B.T.dot(np.linalg.solve(inner, B.dot(g)))) / l2_reg
+        else:
+            H = B.T.dot(B)
+            H[np.diag_indices_from(H)] += l2_reg
+            if l2_reg > 0:
+                step[free] = np.linalg.solve(H, g)
+            else:
+                step[free] = np.linalg.lstsq(H, g, rcond=None)[0]
+        # backtrack along the projected Newton path
+        t = 1.
+        while True:
+            w_new = np.clip(w - t*step, lower, upper)
+            loss_new = fun(w_new)[0]
+            if loss_new <= loss - 1e-4*grad.dot(w - w_new) or t < 1e-10:
+                break
+            t *= 0.5
+        w = w_new
+        loss, grad, hess = fun(w, hessian=True)
+    return optimize.OptimizeResult(x=w, fun=loss, jac=grad, nit=nit, success=success)
+
+def select_lambda(solve, predict, sequence, d, lambdas, top_k=3, workers=1, search='grid',
+    halving_rounds=1, halving_margin=0.02, bracket_margin=0.005, bracket_points=4):
+    """Choose the regularizer by leave-one-out cross-validation over the positives
+    of the sequence. For each left-out positive, the weights of a lambda are
+    solved starting from the solution of the closest lambda solved before, i.e.
+    along the lambda path for 'grid'.
+
+    Input:
+        solve - solve(w0, batch_y, l2_reg) returns the optimize.OptimizeResult of
+            the weights given the observations batch_y, starting from w0.
+        predict - predict(w) returns the predictions given the weights.
+        sequence - numpy array of observations (negatives are -(i+1)).
+        d - dimension of the weights.
+        lambdas - numpy array of candidate regularizers, in increasing order.
+        top_k - avg_lambda is the mean of the top_k lambdas.
+        workers - number of threads solving the left-out positives.
+        search - 'grid' evaluates every lambda on every left-out positive.
+            'bracket' evaluates bracket_points lambdas evenly spaced in
+            log-lambda on every left-out positive, then repeatedly bisects (in
+            log-lambda) the intervals between evaluated lambdas that have an end
+            within bracket_margin of the top_k-th best mean reciprocal rank. The
+            lambdas of the other intervals are not evaluated.
+            'halving' evaluates the lambdas on a growing number of left-out
+            positives, and after each round drops the lambdas whose mean
+            reciprocal rank so far trails the top_k-th best one by more than
+            halving_margin, until the remaining ones are evaluated on all
+            left-out positives. 'pure_halving' (successive halving) keeps the
+            best half of the lambdas (at least top_k) after each round instead.
+            All three are approximate: a lambda that is not evaluated (on all
+            left-out positives) may have been among the top_k of 'grid'.
+        halving_rounds - max number of pruning rounds; round r of R evaluates
+            the lambdas on the first 1/2^(R-r) of the left-out positives.
+        halving_margin - margin of the mean reciprocal rank of 'halving'.
+        bracket_margin - margin of the mean reciprocal rank of 'bracket'.
+        bracket_points - number of lambdas first evaluated by 'bracket'.
+    Output:
+        best_lambda, avg_lambda, and the numpy array of the mean reciprocal ranks
+        of the left-out positives (lambda_scores, nan for the dropped lambdas).
+    """
+    def run_fold(task):
+        j, fold_lambdas = task
+        left_out_idx = left_outs[j]
+        batch_y = np.delete(sequence, left_out_idx, axis=0)
+        solved = solutions[j]
+        map_left_outs = []
+        for i in fold_lambdas:
+            w = np.ones(d)
+            if solved:
+                w = solved[min(sorted(solved), key=lambda k: abs(k - i))]
+            w = solve(w, batch_y, lambdas[i]).x
+            solved[i] = w
+            pred_lambda = predict(w)
+            map_left_outs.append(1./(np.where(np.argsort(-pred_lambda)==sequence[left_out_idx])[0][0]+1))
+        return map_left_outs
+
+    def evaluate(folds, idx):
+        """Evaluate the lambdas idx on the left-out positives folds."""
+        tasks = [(j, idx) for j in folds]
+        results = pool.map(run_fold, tasks) if pool is not None else map(run_fold, tasks)
+        for j, res in zip(folds, results):
+            map_left_outs[idx, j] = res
+        return len(idx) * len(folds)
+
+    assert search in ['grid', 'bracket', 'halving', 'pure_halving']
+    left_outs = [i for i in range(len(sequence)) if sequence[i] >= 0]
+    num_rounds = 0
+    if search == 'halving':
+        # every round adds left-out positives
+        num_rounds = int(np.ceil(np.log2(max(1., len(left_outs)))))
+        num_rounds = min(num_rounds, halving_rounds)
+    elif search == 'pure_halving':
+        num_rounds = int(np.ceil(np.log2(max(1., len(lambdas) / float(top_k)))))
+        num_rounds = min(num_rounds, halving_rounds)
+    pool = ThreadPool(workers) if workers > 1 else None
+    # rows: lambdas, columns: left-out positives
+    map_left_outs = np.full((len(lambdas), len(left_outs)), np.nan)
+    # weights solved for each left-out positive, by lambda index
+    solutions = [ {} for j in left_outs ]
+    solver_calls = 0
+    if search == 'bracket':
+        assert lambdas[0] > 0 and np.all(np.diff(lambdas) > 0)
+        log_lambdas = np.log(lambdas)
+        points = np.linspace(log_lambdas[0], log_lambdas[-1], max(2, bracket_points))
+        new = sorted(set(np.abs(log_lambdas[:,None] - points).argmin(axis=0)))
+        evaluated = [ ]
+        while new:
+            solver_calls += evaluate(range(len(left_outs)), np.array(new))
+            evaluated = sorted(evaluated + new)
+            scores = map_left_outs.mean(axis=1)
+            kth_score = np.sort(scores[evaluated])[::-1][min(top_k, len(evaluated))-1]
+            new = [ ]
+            for a, b in zip(evaluated[:-1], evaluated[1:]):
+                if b - a > 1 and max(scores[a], scores[b]) >= kth_score - bracket_margin:
+                    middle = (log_lambdas[a] + log_lambdas[b]) / 2
+                    new.append(a + 1 + np.abs(log_lambdas[a+1:b] - middle).argmin())
+    else:
+        alive = np.arange(len(lambdas))
+        num_folds = 0
+        for r in range(num_rounds+1):
+            new_folds = range(num_folds, int(np.ceil(len(left_outs) / 2.**(num_rounds-r))))
+            solver_calls += evaluate(new_folds, alive)
+            num_folds += len(new_folds)
+            if r < num_rounds and len(alive) > top_k:
+                scores = map_left_outs[alive, :num_folds].mean(axis=1)
+                if search == 'halving':
+                    kth_score = np.sort(scores)[::-1][top_k-1]
+                    alive = alive[scores >= kth_score - halving_margin]
+                else:
+                    keep = max(top_k, int(np.ceil(len(alive) / 2.)))
+                    # in lambda order, for the warm starts
+                    alive = np.sort(alive[np.argsort(-scores, kind='mergesort')[:keep]])
+    if pool is not None:
+        pool.close()
+    for map_lambda in map_left_outs:
+        print list(map_lambda)
+    if search != 'grid':
+        print "Lambda search: {} solver calls, {} saved".format(
+            solver_calls, len(lambdas) * len(left_outs) - solver_calls)
+    lambda_scores = map_left_outs.mean(axis=1)
+    best_lambda = lambdas[np.where(lambda_scores==np.nanmax(lambda_scores))[0][0]]
+    #lambda_weights = np.exp2(-(len(lambda_scores)-1-np.argsort(np.argsort(lambda_scores))))
+    #avg_lambda = (lambda_weights*lambdas).sum() / lambda_weights.sum()
+    # nan (dropped) scores are sorted last
+    avg_lambda = lambdas[np.argsort(-lambda_scores)[:top_k]].mean()
+    return best_lambda, avg_lambda, lambda_scores
+
 def run_online(ing_idx, reps, reps_prod, binary, skip_online_updates, use_pair, sequence, batch,
-    l2_reg, learn_lambda_min_pos, maxiter, step_size, method, lower_bound, upper_bound, ing_cat_pair_map=None):
-    def loss_func1(w):
-        pred = p_y_given_x(reps, reps_prod.T, binary, w)[0]
+    l2_reg, learn_lambda_min_pos, maxiter, step_size, method, lower_bound, upper_bound, ing_cat_pair_map=None,
+    tol=None, lambdas=None, lambda_top_k=3, cv_workers=1, lambda_search='grid', halving_rounds=1,
+    halving_margin=0.02, bracket_margin=0.005):
+    # Both losses return (loss, gradient) for optimize.minimize(jac=True), and
+    # also the Hessian (B, l2_reg) for newton_minimize (binary predictions only).
+    def loss_func1(w, batch_y, l2_reg, hessian=False):
+        pred = predict(w)
         #prob = pred[batch_y]
-        prob = pred[[i if i>=0 else -(i+1) for i in batch_y]]
-        prob = [p if batch_y[i]>=0 else 1-p for i,p in enumerate(prob)]
+        y = np.asarray(batch_y)
+        idx = np.where(y>=0, y, -(y+1))
+        pos = y>=0
+        prob = np.where(pos, pred[idx], 1-pred[idx])
         loss = -(np.sum(np.log(prob)) - l2_reg/2*np.sum((w-1)**2))#-np.sum(np.log(w)-w+1))
-        return loss
-    def loss_func2(w):
-        prob = []
-        for pos_idx, neg_idx in batch_y:
-            neg_idx = -(neg_idx + 1)
-            v = p_y_given_x(reps, (reps_prod[pos_idx]-reps_prod[neg_idx]).T, binary, w)[0]
-            prob.append(v)
+        # gradient wrt the logits of the categories
+        if binary:
+            dz = np.bincount(idx, weights=pred[idx]-pos, minlength=num_categories)
+        else:
+            # -log p_i: p - e_i; -log(1-p_i): p_i/(1-p_i) * (e_i - p)
+            coefs = np.where(pos, -1., pred[idx]/(1-pred[idx]))
+            dz = np.bincount(idx, weights=coefs, minlength=num_categories) + \
+                (pos.sum() - coefs[~pos].sum()) * pred
+        grad = scaled.T.dot(dz) + l2_reg*(w-1)
+        if not hessian:
+            return loss, grad
+        h = np.bincount(idx, weights=pred[idx]*(1-pred[idx]), minlength=num_categories)
+        rows = np.nonzero(h)[0]
+        return loss, grad, (np.sqrt(h[rows])[:,None] * scaled[rows], l2_reg)
+    def loss_func2(w, batch_y, l2_reg, hessian=False):
+        pos_idx = [pos_idx for pos_idx, neg_idx in batch_y]
+        neg_idx = [-(neg_idx + 1) for pos_idx, neg_idx in batch_y]
+        diff = scaled[pos_idx] - scaled[neg_idx]
+        prob = sigmoid(diff.dot(w))
         loss = -(np.sum(np.log(prob)) - l2_reg/2*np.sum((w-1)**2))#-np.sum(np.log(w)-w+1))
-        return loss
+        grad = -diff.T.dot(1-prob) + l2_reg*(w-1)
+        if not hessian:
+            return loss, grad
+        return loss, grad, (np.sqrt(prob*(1-prob))[:,None] * diff, l2_reg)
+    def solve(w, batch_y, l2_reg):
+        fun = lambda w, hessian=False: loss_func(w, batch_y, l2_reg, hessian)
+        if method == 'newton':
+            return newton_minimize(fun, w, lower_bound, upper_bound, tol, maxiter)
+        return optimize.minimize(fun, w, 
+            method=method, 
+            jac=True,
+            tol=tol,
+            options=ops,
+            bounds=[(lower_bound, upper_bound)]*len(w)
+        )
+    def predict(w):
+        # same as p_y_given_x(reps, reps_prod.T, binary, w)[0]
+        return f(scaled.dot(w).reshape(1,-1))[0]
 
     sequence = np.array(sequence)
     d = reps.shape[1]
+    f = sigmoid if binary else softmax
+    # logits of the categories are scaled.dot(w)
+    scaled = reps[0] * reps_prod
     w = np.ones(d)
     eps = np.sqrt(np.finfo(float).eps)
     num_categories = reps_prod.shape[0]
     seen_indices = set()
     remaining_indices = range(num_categories)
-    orig_pred = p_y_given_x(reps, reps_prod.T, binary, w)[0]
+    orig_pred = predict(w)
     pred = orig_pred
     loss_func = loss_func2 if use_pair else loss_func1
     ops = {}
@@ -229,46 +454,19 @@ def run_online(ing_idx, reps, reps_prod, binary, skip_online_updates, use_pair,
         ops['eps'] = step_size
     if method is None:
         method = 'BFGS' if (lower_bound is None and upper_bound is None) else 'L-BFGS-B'
+    assert binary or method != 'newton', "newton needs binary predictions"
         
     # Find optimum lambda
-    lambdas = np.array([0.085, 0.09, 0.095, 0.1, 0.105, 0.11, 0.115])
-    #lambdas = np.array([0.01, 0.03, 0.05, 0.07, 0.1, 0.14, 0.18, 0.22])
-    lambda_scores = []
+    if lambdas is None:
+        lambdas = np.array([0.085, 0.09, 0.095, 0.1, 0.105, 0.11, 0.115])
+        #lambdas = np.array([0.01, 0.03, 0.05, 0.07, 0.1, 0.14, 0.18, 0.22])
     print len(sequence)
     num_pos = len(sequence) if use_pair else (sequence>=0).sum()
     if not use_pair and learn_lambda_min_pos and num_pos >= learn_lambda_min_pos and num_pos < 20:
         # Choose best lambda via cross-validation.
-        for l2_reg in lambdas:
-            map_left_outs = []
-            for left_out_idx in range(len(sequence)):
-                if use_pair:
-                    left_out_pos_idx = sequence[left_out_idx][0]
-                else:
-                    left_out_pos_idx = sequence[left_out_idx]
-                if not use_pair and left_out_pos_idx<0:
-                    continue
-                w = np.ones(d)
-                new_sequence = np.delete(sequence, left_out_idx, axis=0)
-                batch_y = new_sequence
-                res = optimize.minimize(loss_func, w, 
-                    method=method, 
-                    options=ops,
-                    bounds=[(lower_bound, upper_bound)]*len(w)
-                )
-                w = res.x
-                pred_lambda = p_y_given_x(reps, reps_prod.T, binary, w)[0]
-                map_left_out = 1./(np.where(np.argsort(-pred_lambda)==left_out_pos_idx)[0][0]+1)
-                map_left_outs.append(map_left_out)
-            print map_left_outs
-            lambda_scores.append(np.mean(map_left_outs))
-            #print l2_reg, map_left_outs, pred_lambda, w
-        
-        lambda_scores = np.array(lambda_scores)
-        best_lambda = lambdas[np.where(lambda_scores==max(lambda_scores))[0][0]]
-        #lambda_weights = np.exp2(-(len(lambda_scores)-1-np.argsort(np.argsort(lambda_scores))))
-        lambda_weights = np.argsort(np.argsort(lambda_scores))
-        #avg_lambda = (lambda_weights*lambdas).sum() / lambda_weights.sum()
-        avg_lambda = lambdas[np.argsort(-lambda_scores)[:3]].mean()
+        best_lambda, avg_lambda, lambda_scores = select_lambda(
+            solve, predict, sequence, d, lambdas, lambda_top_k, cv_workers, lambda_search,
+            halving_rounds, halving_margin, bracket_margin)
         print best_lambda, avg_lambda, lambda_scores
         l2_reg = avg_lambda #best_lambda#orig_lambda
 
@@ -326,14 +524,10 @@ def run_online(ing_idx, reps, reps_prod, binary, skip_online_updates, use_pair,
                 l2_reg *= min(5, map_score_orig / map_score_rand) 
 
         batch_y = sequence[t:max(0,t-batch):-1]
-        res = optimize.minimize(loss_func, w, 
-            method=method, 
-            options=ops,
-            bounds=[(lower_bound, upper_bound)]*len(w)
-        )
+        res = solve(w, batch_y, l2_reg)
         w = res.x
 
-        pred = p_y_given_x(reps, reps_prod.T, binary, w)[0]
+        pred = predict(w)
         if t in [1, len(sequence)-1]:
             print "Num observations:", t+1
             print "Remaining categories:", len(remaining_indices)
@@ -422,6 +616,132 @@ def plot_stuff():
     plt.grid()
     plt.show()
 
+# Data and settings of the ingredient tasks, set by main() before the pool of
+# worker processes is forked.
+ing_task_data = {}
+
+def run_ingredient(task):
+    """Run iterations_per_ing random sequences of one ingredient.
+
+    Input:
+        task - (i, ind, seed): position and index of the ingredient, and the
+            seed of the random sequences.
+    Output:
+        dict of the results of the ingredient, or None if it is skipped.
+    """
+    i, ind, seed = task
+    np.random.seed(seed)
+    data = ing_task_data
+    binary = data['binary']
+    use_pair = data['use_pair']
+    num_categories = data['num_categories']
+    ing_cat_pair_map = data['ing_cat_pair_map']
+    if data['use_askubuntu']:
+        reps = data['reps']
+        rep = np.array([reps[ind]])
+        reps_prod = get_similar_reps(reps, data['q20s'][ind])
+        pred = p_y_given_x(rep, reps_prod.T, binary)[0]
+        counts = get_counts(data['similar_qs'][ind], data['q20s'][ind])
+        ing = ind
+    else:
+        rep = data['reps'][i:i+1]
+        reps_prod = data['reps_prod']
+        pred = data['predictions'][i]
+        counts = data['input_to_outputs'][ind]
+        ing = data['ings'][ind]
+    if len(np.where(counts>0)[0]) <= 1:
+        return None # need at least 2 observations
+    if use_pair and len(np.where(counts==0)[0]) == 0:
+        return None # need at least 1 negative
+    iter_start_time = time.time()
+    if binary:
+        true_dist = convert_to_zero_one(counts)
+    else:
+        true_dist = counts.astype(float) / counts.sum()
+    res = { 'ing' : ing }
+    for key in ['all_l2_reg', 'map_improvements_1', 'map_improvements_final',
+            'map_improvements_post', 'map_improvements_rand', 'maps_1_orig',
+            'maps_final_orig', 'maps_prior_orig', 'all_min_losses', 'all_uniform_losses',
+            'all_baseline_losses', 'all_batchall_losses']:
+        res[key] = []
+
+    print '=========================================='
+    print i, ind, ing
+    for iteration in range(data['iterations_per_ing']):
+        print "Iteration:", iteration+1
+        sequence = gen_sequence(counts, data['add_negatives'], data['max_positives'],
+            data['max_total'], data['max_negatives_ratio'], use_pair)
+        if use_pair and data['max_total']:
+            # filter by pair scores
+            seq_scores = [pred[pos_idx]-pred[neg_idx] for pos_idx, neg_idx in sequence]
+            sequence = [sequence[k] for k in sorted(np.argsort(seq_scores)[:data['max_total']])]
+        if iteration == 0:
+            if use_pair:
+                print "# pairs: {}, {} total Pos".format(len(sequence), (counts>0).sum())
+            else:
+                print "# Pos in seq: {} / {}, {} total Pos".format((sequence>=0).sum(), len(sequence), (counts>0).sum())
+            res['sequence_len'] = len(sequence)
+            res['num_pos'] = (counts>0).sum()
+            min_loss = get_baseline_loss(ind, true_dist, sequence, ing_cat_pair_map) # should be 0 for binary
+            if binary:
+                uniform_loss = get_baseline_loss(ind, np.ones(num_categories)/2., sequence, ing_cat_pair_map)
+            else:
+                uniform_loss = get_baseline_loss(ind, np.ones(num_categories, dtype=float)/num_categories, sequence, ing_cat_pair_map)
+            baseline_loss = get_baseline_loss(ind, pred, sequence, ing_cat_pair_map)
+
+        batchall_loss, w_batchall, new_l2_reg, map_1_orig, map_1_new, map_final_orig, \
+            map_final_new, map_prior, map_posterior, map_rand = run_online(
+            ind, rep, reps_prod, binary, data['skip_online_updates'], use_pair, sequence, len(sequence),
+            data['l2_reg'], data['learn_lambda_min_pos'], data['maxiter'], data['step_size'],
+            data['method'], data['lower_bound'], data['upper_bound'], ing_cat_pair_map, data['tol'],
+            data['lambdas'], data['lambda_top_k'], data['cv_workers'], data['lambda_search'],
+            data['halving_rounds'], data['halving_margin'], data['bracket_margin'])
+        res['all_l2_reg'].append(new_l2_reg)
+        res['map_improvements_1'].append(map_1_new - map_1_orig)
+        res['map_improvements_final'].append(map_final_new - map_final_orig)
+        res['map_improvements_post'].append(map_posterior - map_prior)
+        res['map_improvements_rand'].append(map_final_orig-map_rand)
+        res['maps_1_orig'].append(map_1_orig)
+        res['maps_final_orig'].append(map_final_orig)
+        res['maps_prior_orig'].append(map_prior)
+
+        res['all_min_losses'].append(min_loss)
+        res['all_uniform_losses'].append(uniform_loss)
+        res['all_baseline_losses'].append(baseline_loss)
+        res['all_batchall_losses'].append(batchall_loss)
+
+    if not data['use_askubuntu']:# and print_predictions:
+        idx_to_cat = data['idx_to_cat']
+        ings_wiki_links = data['ings_wiki_links']
+        pos_cats = [idx_to_cat[pos_idx] for pos_idx in sequence[sequence>=0]]
+        print "Observed cats:", pos_cats
+        # True distribution
+        test_model(true_dist.reshape(1,-1), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
+        # Baseline prediction
+        test_model(pred.reshape(1,-1), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
+        # After batchall update
+        test_model(p_y_given_x(rep, reps_prod.T, binary, w_batchall), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
+    print "True loss      :", min_loss
+    print "Uniform loss   :", uniform_loss
+    print "Baseline loss  :", baseline_loss
+    print "Batch all loss :", batchall_loss
+    print w_batchall[:10]
+    res['final_weights'] = w_batchall
+
+    print "Iter time elapsed: {:.1f}s".format((time.time()-iter_start_time))
+    return res
+
+def run_ingredient_captured(task):
+    """run_ingredient for a worker process: returns its printed output with the
+    results, so that the output of the ingredients is not interleaved."""
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    try:
+        res = run_ingredient(task)
+        return sys.stdout.getvalue(), res
+    finally:
+        sys.stdout = stdout
+
 def main(args):
     print args
     use_args = True
@@ -448,7 +768,8 @@ def main(args):
     step_size = None#1e-5
     add_negatives = True
     batch_k = 10
-    method = None
+    method = args.method
+    tol = args.tol
     binary = True
 
     assert dataset in ['train', 'dev', 'test']
@@ -579,117 +900,85 @@ def main(args):
     final_weights = []
     all_l2_reg = []
     start_time = time.time()
-    cur_iteration = 0
     indices2 = list(enumerate(indices))[::-1]
     #np.random.shuffle(indices2)
+    tasks = []
     for i, ind in indices2:#enumerate(indices):
         if not use_askubuntu and ind >= 5000:
             # skip adulterants
             continue
-        cur_iteration += 1
-        if max_iterations and cur_iteration > max_iterations:
+        if max_iterations and len(tasks) >= max_iterations:
             break
-        iter_start_time = time.time()
-        if use_askubuntu:
-            rep = np.array([reps[ind]])
-            reps_prod = get_similar_reps(reps, q20s[ind])
-            pred = p_y_given_x(rep, reps_prod.T, binary)[0]
-            counts = get_counts(similar_qs[ind], q20s[ind])
-            ing = ind
-        else:
-            rep = reps[i:i+1]
-            pred = predictions[i]
-            counts = input_to_outputs[ind]
-            ing = ings[ind]
-        if len(np.where(counts>0)[0]) <= 1:
-            continue # need at least 2 observations
-        if use_pair and len(np.where(counts==0)[0]) == 0:
-            continue # need at least 1 negative
-        observed_ings.append(ing)
-        if binary:
-            true_dist = convert_to_zero_one(counts)
-        else:
-            true_dist = counts.astype(float) / counts.sum()
-        
-        print '=========================================='
-        print i, ind, ing
-        for iteration in range(iterations_per_ing):
-            print "Iteration:", iteration+1
-            sequence = gen_sequence(counts, add_negatives, max_positives, max_total, max_negatives_ratio, use_pair)
-            if use_pair and max_total:
-                # filter by pair scores
-                seq_scores = [pred[pos_idx]-pred[neg_idx] for pos_idx, neg_idx in sequence]
-                sequence = [sequence[i] for i in sorted(np.argsort(seq_scores)[:max_total])]
-            #if (counts>0).sum() > 5:
-            #    l2_reg = 0.01
-            if iteration == 0:
-                if use_pair:
-                    print "# pairs: {}, {} total Pos".format(len(sequence), (counts>0).sum())
-                else:
-                    print "# Pos in seq: {} / {}, {} total Pos".format((sequence>=0).sum(), len(sequence), (counts>0).sum())
-                sequence_lens.append(len(sequence))
-                num_pos.append((counts>0).sum())
-                min_loss = get_baseline_loss(ind, true_dist, sequence, ing_cat_pair_map) # should be 0 for binary
-                if binary:
-                    uniform_loss = get_baseline_loss(ind, np.ones(num_categories)/2., sequence, ing_cat_pair_map)
-                else:
-                    uniform_loss = get_baseline_loss(ind, np.ones(num_categories, dtype=float)/num_categories, sequence, ing_cat_pair_map)
-                baseline_loss = get_baseline_loss(ind, pred, sequence, ing_cat_pair_map)
-            #naive_online_loss, naive_pred = run_naive_online(rep, reps_prod, binary, sequence, naive_mutiplier)
-            
-        
-            batchall_loss, w_batchall, new_l2_reg, map_1_orig, map_1_new, map_final_orig, \
-                map_final_new, map_prior, map_posterior, map_rand = run_online(
-                ind, rep, reps_prod, binary, skip_online_updates, use_pair, sequence, len(sequence), l2_reg, \
-                learn_lambda_min_pos, maxiter, step_size, method, lower_bound, upper_bound, ing_cat_pair_map)
-            map_improvement_1 = map_1_new - map_1_orig
-            map_improvement_final = map_final_new - map_final_orig
-            map_improvement_post = map_posterior - map_prior
-            #batchk_loss, w_batchk = run_online(rep, reps_prod, binary, use_pair, sequence, batch_k, l2_reg, step_size, method, lower_bound, upper_bound)
-            #online_loss, w_online = run_online(rep, reps_prod, binary, use_pair, sequence, 1, l2_reg, step_size, method, lower_bound, upper_bound)
-            all_l2_reg.append(new_l2_reg)
-            map_improvements_1.append(map_improvement_1)
-            map_improvements_final.append(map_improvement_final)
-            map_improvements_post.append(map_improvement_post)
-            map_improvements_rand.append(map_final_orig-map_rand)
-            maps_1_orig.append(map_1_orig)
-            maps_final_orig.append(map_final_orig)
-            maps_prior_orig.append(map_prior)
-
-            all_min_losses.append(min_loss)
-            all_uniform_losses.append(uniform_loss)
-            all_baseline_losses.append(baseline_loss)
-            #all_naive_online_losses.append(naive_online_loss)
-            all_batchall_losses.append(batchall_loss)
-            #all_batchk_losses.append(batchk_loss)
-            #all_online_losses.append(online_loss)
-
-        if not use_askubuntu:# and print_predictions:
-            pos_cats = [idx_to_cat[pos_idx] for pos_idx in sequence[sequence>=0]]
-            print "Observed cats:", pos_cats
-            # True distribution
-            test_model(true_dist.reshape(1,-1), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
-            # Baseline prediction
-            test_model(pred.reshape(1,-1), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
-            # Naive algo prediction
-            #test_model(naive_pred.reshape(1,-1), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
-            # After batchall update
-            test_model(p_y_given_x(rep, reps_prod.T, binary, w_batchall), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
-            # After batchk update
-            #test_model(p_y_given_x(rep, reps_prod.T, binary, w_batchk), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
-            # After online update
-            #test_model(p_y_given_x(rep, reps_prod.T, binary, w_online), [ing], idx_to_cat, top_n=10, ings_wiki_links=ings_wiki_links)
-        print "True loss      :", min_loss
-        print "Uniform loss   :", uniform_loss
-        print "Baseline loss  :", baseline_loss
-        #print "Naive Algo loss:", naive_online_loss
-        print "Batch all loss :", batchall_loss
-        #print "Batch k loss   :", batchk_loss
-        #print "Online loss    :", online_loss
-        print w_batchall[:10]#, w_batchk[:10], w_online[:10]
-        final_weights.append(w_batchall)
+        # the sequences of an ingredient only depend on --seed and the ingredient
+        tasks.append((i, ind, [seed, ind]))
+
+    ing_task_data.update(
+        use_askubuntu = use_askubuntu,
+        reps = reps,
+        reps_prod = None if use_askubuntu else reps_prod,
+        q20s = q20s if use_askubuntu else None,
+        similar_qs = similar_qs if use_askubuntu else None,
+        predictions = None if use_askubuntu else predictions,
+        input_to_outputs = None if use_askubuntu else input_to_outputs,
+        ings = None if use_askubuntu else ings,
+        idx_to_cat = None if use_askubuntu else idx_to_cat,
+        ings_wiki_links = None if use_askubuntu else ings_wiki_links,
+        ing_cat_pair_map = ing_cat_pair_map,
+        num_categories = num_categories,
+        binary = binary,
+        use_pair = use_pair,
+        iterations_per_ing = iterations_per_ing,
+        add_negatives = add_negatives,
+        max_positives = max_positives,
+        max_total = max_total,
+        max_negatives_ratio = max_negatives_ratio,
+        skip_online_updates = skip_online_updates,
+        l2_reg = l2_reg,
+        learn_lambda_min_pos = learn_lambda_min_pos,
+        maxiter = maxiter,
+        step_size = step_size,
+        method = method,
+        lower_bound = lower_bound,
+        upper_bound = upper_bound,
+        tol = tol,
+        lambdas = np.array(args.lambdas),
+        lambda_top_k = args.lambda_top_k,
+        cv_workers = args.cv_workers,
+        lambda_search = args.lambda_search,
+        halving_rounds = args.halving_rounds,
+        halving_margin = args.halving_margin,
+        bracket_margin = args.bracket_margin
+    )
+    if args.workers > 1:
+        pool = multiprocessing.Pool(args.workers)
+        results = pool.imap(run_ingredient_captured, tasks)
+    else:
+        pool = None
+        results = ((None, run_ingredient(task)) for task in tasks)
+
+    # results come in the order of the tasks, whatever the number of workers
+    for output, res in results:
+        if output:
+            sys.stdout.write(output)
+        if res is None:
+            continue
+        observed_ings.append(res['ing'])
+        sequence_lens.append(res['sequence_len'])
+        num_pos.append(res['num_pos'])
+        all_l2_reg.extend(res['all_l2_reg'])
+        map_improvements_1.extend(res['map_improvements_1'])
+        map_improvements_final.extend(res['map_improvements_final'])
+        map_improvements_post.extend(res['map_improvements_post'])
+        map_improvements_rand.extend(res['map_improvements_rand'])
+        maps_1_orig.extend(res['maps_1_orig'])
+        maps_final_orig.extend(res['maps_final_orig'])
+        maps_prior_orig.extend(res['maps_prior_orig'])
+        all_min_losses.extend(res['all_min_losses'])
+        all_uniform_losses.extend(res['all_uniform_losses'])
+        all_baseline_losses.extend(res['all_baseline_losses'])
+        all_batchall_losses.extend(res['all_batchall_losses'])
+        final_weights.append(res['final_weights'])
         
-        print "Iter time elapsed: {:.1f}s".format((time.time()-iter_start_time))
         print "-------------------------------------------------------"
         print "Mean True Loss      :", np.mean(all_min_losses)
         print "Mean Uniform Loss   :", np.mean(all_uniform_losses)
@@ -712,6 +1001,9 @@ def main(args):
         print "% map_improvements_final > 0:", (np.array(map_improvements_final) > 0).mean(), (np.array(map_improvements_final) == 0).mean(), (np.array(map_improvements_final) < 0).mean()
         print "% map_improvements_post > 0 :", (np.array(map_improvements_post) > 0).mean(), (np.array(map_improvements_post) == 0).mean(), (np.array(map_improvements_post) < 0).mean()
     print "Time elapsed: {:.1f}m".format((time.time()-start_time)/60)
+    if pool is not None:
+        pool.close()
+        pool.join()
     if save_id:
         np.save('seq_results/observed_ings_{}.npy'.format(save_id), np.array(observed_ings))
         np.save('seq_results/maps_final_orig_{}.npy'.format(save_id), np.array(maps_final_orig))
@@ -781,6 +1073,65 @@ if __name__ == "__main__":
     argparser.add_argument("--max_iterations",
             type = int,
         )
+    argparser.add_argument("--method",
+            type = str,
+            help = "solver of the weights: a scipy.optimize.minimize method, or 'newton' "
+                   "for a projected Newton method with the exact Hessian "
+                   "(default: BFGS, or L-BFGS-B with bounds)"
+        )
+    argparser.add_argument("--tol",
+            type = float,
+            help = "tolerance of the solver"
+        )
+    argparser.add_argument("--workers",
+            type = int,
+            default = 1,
+            help = "number of processes running the ingredients in parallel"
+        )
+    argparser.add_argument("--lambdas",
+            type = lambda s: [float(x) for x in s.split(',')],
+            default = [0.085, 0.09, 0.095, 0.1, 0.105, 0.11, 0.115],
+            help = "comma-separated candidate regularizers of the lambda cross-validation"
+        )
+    argparser.add_argument("--lambda_top_k",
+            type = int,
+            default = 3,
+            help = "the learned regularizer is the mean of the top k candidates"
+        )
+    argparser.add_argument("--cv_workers",
+            type = int,
+            default = 1,
+            help = "number of threads running the lambda cross-validation folds"
+        )
+    argparser.add_argument("--lambda_search",
+            type = str,
+            default = "grid",
+            help = "'grid': cross-validate every lambda on every left-out positive; "
+                   "'bracket': only cross-validate the lambdas bisecting (in log-lambda) the "
+                   "intervals around the top k; 'halving': drop the lambdas trailing the top k "
+                   "by more than --halving_margin early; 'pure_halving': drop the worse half of "
+                   "the lambdas early (successive halving). All but 'grid' are approximate. On "
+                   "239 synthetic sequences with the default margins and rounds, 'bracket' chose "
+                   "the avg_lambda of 'grid' in all of them and saved 9-10%% of the solves with "
+                   "14 log-spaced lambdas, 1-3%% with 8, none with the 7 default ones; 'halving' "
+                   "differed in 5 and saved 0-7%%; 'pure_halving' differed in 96 and saved 21-24%%"
+        )
+    argparser.add_argument("--halving_rounds",
+            type = int,
+            default = 1,
+            help = "max number of pruning rounds of --lambda_search halving/pure_halving (more "
+                   "save more solves, but drop lambdas based on fewer left-out positives)"
+        )
+    argparser.add_argument("--halving_margin",
+            type = float,
+            default = 0.02,
+            help = "mean reciprocal rank margin of --lambda_search halving (larger drop fewer lambdas)"
+        )
+    argparser.add_argument("--bracket_margin",
+            type = float,
+            default = 0.005,
+            help = "mean reciprocal rank margin of --lambda_search bracket (larger evaluate more lambdas)"
+        )
     argparser.add_argument("--save_id",
             type = int,
         )
@@ -12,5 +12,5 @@ from utils import say
 from .initialization import *
 from .basic import *
 from .advanced import *
-from .optimization import create_optimization_updates
+from .optimization import create_optimization_updates, get_optimizer_state, FlatParams
 
@@ -12,6 +12,9 @@
                                  initial hidden state, and return all hidden
                                  states h1, ..., h_n
 
+    forward_all() also takes an optional (len, batch) mask for batches of
+    sequences padded at the end; states of padded positions are set to zero.
+
     @author: Tao Lei (taolei@csail.mit.edu)
 '''
 
@@ -21,7 +24,7 @@ import theano.tensor as T
 
 from .initialization import random_init, create_shared
 from .initialization import ReLU, tanh, linear, sigmoid
-from .basic import Layer, RecurrentLayer
+from .basic import Layer, RecurrentLayer, shift_sequence, apply_mask
 
 '''
     This class implements the non-consecutive, non-linear CNN model described in
@@ -29,11 +32,26 @@ from .basic import Layer, RecurrentLayer
 '''
 class StrCNN:
 
-    def __init__(self, n_in, n_out, activation=None, decay=0.0, order=2, use_all_grams=True):
+    '''
+        StrCNN
+
+        Inputs
+        ------
+
+            decay           : decay factor of non-consecutive n-grams
+            order           : n-gram order (1, 2 or 3)
+            use_all_grams   : whether to sum up the features of all orders
+            precompute      : whether forward_all() computes the n-gram states of all
+                              positions at once with decayed prefix sums (default);
+                              theano.scan is used otherwise, or when |decay| >= 1
+    '''
+    def __init__(self, n_in, n_out, activation=None, decay=0.0, order=2, use_all_grams=True,
+            precompute=True):
         self.n_in = n_in
         self.n_out = n_out
         self.order = order
         self.use_all_grams = use_all_grams
+        self.precompute = precompute
         self.decay = theano.shared(np.float64(decay).astype(theano.config.floatX))
         if activation is None:
             self.activation = lambda x: x
@@ -66,17 +84,68 @@ class StrCNN:
         f3_t = T.dot(x_t, R) * s2_tm1
         return f1_t, s1_t, f2_t, s2_t, f3_t
 
-    def forward_all(self, x, v0=None):
-        if v0 is None:
-            if x.ndim > 1:
-                v0 = T.zeros((x.shape[1], self.n_out), dtype=theano.config.floatX)
-            else:
-                v0 = T.zeros((self.n_out,), dtype=theano.config.floatX)
-        ([f1, s1, f2, s2, f3], updates) = theano.scan(
-                        fn = self.forward,
-                        sequences = x,
-                        outputs_info = [ v0, v0, v0, v0, v0 ]
-                )
+    '''
+        Return the number of doubling steps needed by decayed_cumsum() so that the
+        truncated terms are below the float precision, or None if the decay does
+        not vanish (|decay| >= 1)
+    '''
+    def num_doubling_steps(self):
+        decay = abs(float(self.decay.get_value()))
+        if decay == 0:
+            return 0
+        if decay >= 1:
+            return None
+        eps = np.finfo(theano.config.floatX).eps
+        span = np.log(eps) / np.log(decay)
+        return max(1, int(np.ceil(np.log2(span))))
+
+    '''
+        Compute s_t = decay * s_{t-1} + f_t (with s_0 = 0) for all positions at
+        once. After i doubling steps s_t = \sum_{k<2^i} decay^k f_{t-k}.
+    '''
+    def decayed_cumsum(self, f, steps):
+        s = f
+        for i in range(steps):
+            k = 2**i
+            s = s + (self.decay**k) * shift_sequence(s, k)
+        return s
+
+    '''
+        Compute the n-gram features f1, f2, f3 of all positions without scan;
+        only the projections needed by the order are computed. Features of
+        orders above self.order are returned as None.
+    '''
+    def forward_parallel(self, x, steps):
+        order, n_out = self.order, self.n_out
+        proj = T.dot(x, T.concatenate([ self.P, self.Q, self.R ][:order], axis=1))
+        lead = (slice(None),) * (x.ndim-1)
+        xP, xQ, xR = [ proj[lead + (slice(n_out*i, n_out*i+n_out),)] if i < order else None
+                            for i in range(3) ]
+        f1 = xP
+        f2 = f3 = None
+        if order > 1:
+            s1 = self.decayed_cumsum(f1, steps)
+            f2 = xQ * shift_sequence(s1, 1)
+        if order > 2:
+            s2 = self.decayed_cumsum(f2, steps)
+            f3 = xR * shift_sequence(s2, 1)
+        return f1, f2, f3
+
+    def forward_all(self, x, v0=None, mask=None):
+        steps = self.num_doubling_steps() if self.precompute and v0 is None else None
+        if steps is not None:
+            f1, f2, f3 = self.forward_parallel(x, steps)
+        else:
+            if v0 is None:
+                if x.ndim > 1:
+                    v0 = T.zeros((x.shape[1], self.n_out), dtype=theano.config.floatX)
+                else:
+                    v0 = T.zeros((self.n_out,), dtype=theano.config.floatX)
+            ([f1, s1, f2, s2, f3], updates) = theano.scan(
+                            fn = self.forward,
+                            sequences = x,
+                            outputs_info = [ v0, v0, v0, v0, v0 ]
+                    )
         if self.order == 3:
             h = f1+f2+f3 if self.use_all_grams else f3
         elif self.order == 2:
@@ -87,7 +156,7 @@ class StrCNN:
             raise ValueError(
                     "Unsupported order: {}".format(self.order)
                 )
-        return self.activation(T.dot(h, self.O) + self.b)
+        return apply_mask(self.activation(T.dot(h, self.O) + self.b), mask)
 
     @property
     def params(self):
@@ -404,9 +473,14 @@ class RCNN:
             has_outgate     : whether to add a output gate as in LSTM; this can be
                               useful for language modeling
             mode            : 0 if non-linear filter; 1 if linear filter (default)
+            precompute      : whether forward_all() computes the input projections
+                              of all positions with one matrix product before
+                              the recurrent steps (default); otherwise they are
+                              computed inside every step
     '''
     def __init__(self, n_in, n_out, activation=tanh,
-            order=1, has_outgate=False, mode=1, clip_gradients=False):
+            order=1, has_outgate=False, mode=1, clip_gradients=False,
+            precompute=True):
 
         self.n_in = n_in
         self.n_out = n_out
@@ -415,6 +489,7 @@ class RCNN:
         self.clip_gradients = clip_gradients
         self.has_outgate = has_outgate
         self.mode = mode
+        self.precompute = precompute
 
         internal_layers = self.internal_layers = [ ]
         for i in range(order):
@@ -422,15 +497,21 @@ class RCNN:
                     clip_gradients=clip_gradients)
             internal_layers.append(input_layer)
 
-        forget_gate = RecurrentLayer(n_in, n_out, sigmoid, clip_gradients)
+        forget_gate = self.create_gate(sigmoid)
         internal_layers.append(forget_gate)
 
         self.bias = create_shared(random_init((n_out,)), name="bias")
 
         if has_outgate:
-            self.out_gate = RecurrentLayer(n_in, n_out, sigmoid, clip_gradients)
+            self.out_gate = self.create_gate(sigmoid)
             self.internal_layers += [ self.out_gate ]
 
+    '''
+        Create a gate layer; gates of RCNN depend on both x_t and h_{t-1}
+    '''
+    def create_gate(self, activation):
+        return RecurrentLayer(self.n_in, self.n_out, activation, self.clip_gradients)
+
     '''
         One step of recurrent
 
@@ -446,7 +527,7 @@ class RCNN:
             return hidden/visible states at time/position t
     '''
     def forward(self, x, hc):
-        order, n_in, n_out, activation = self.order, self.n_in, self.n_out, self.activation
+        order, n_in, n_out = self.order, self.n_in, self.n_out
         layers = self.internal_layers
         if hc.ndim > 1:
             h_tm1 = hc[:, n_out*order:]
@@ -454,13 +535,74 @@ class RCNN:
             h_tm1 = hc[n_out*order:]
 
         forget_t = layers[order].forward(x, h_tm1)
+        in_t = [ layers[i].forward(x) for i in range(order) ]
+        out_t = self.out_gate.forward(x, h_tm1) if self.has_outgate else None
+        return self.update_states(hc, forget_t, in_t, out_t)
+
+    '''
+        One step of recurrent, given the input projections of the current
+        position computed by project_inputs()
+
+        Inputs
+        ------
+
+            px          : projected input at current time/position t
+            hc          : hidden/visible states at time/position t-1
+            W_h         : recurrent weights of the gates, see recurrent_weights()
+
+        Outputs
+        -------
+
+            return hidden/visible states at time/position t
+    '''
+    def forward_precomputed(self, px, hc, W_h):
+        order, n_out = self.order, self.n_out
+        layers = self.internal_layers
+        if hc.ndim > 1:
+            h_tm1 = hc[:, n_out*order:]
+            px_in, px_gates = px[:, :n_out*order], px[:, n_out*order:]
+        else:
+            h_tm1 = hc[n_out*order:]
+            px_in, px_gates = px[:n_out*order], px[n_out*order:]
+
+        gates_t = px_gates + T.dot(h_tm1, W_h)
+        if hc.ndim > 1:
+            forget_t = layers[order].activation(gates_t[:, :n_out])
+            in_t = [ px_in[:, n_out*i:n_out*i+n_out] for i in range(order) ]
+            out_t = self.out_gate.activation(gates_t[:, n_out:]) \
+                        if self.has_outgate else None
+        else:
+            forget_t = layers[order].activation(gates_t[:n_out])
+            in_t = [ px_in[n_out*i:n_out*i+n_out] for i in range(order) ]
+            out_t = self.out_gate.activation(gates_t[n_out:]) \
+                        if self.has_outgate else None
+        return self.update_states(hc, forget_t, in_t, out_t)
+
+    '''
+        Update the filter states given the gate values of the current step
+
+        Inputs
+        ------
+
+            hc          : hidden/visible states at time/position t-1
+            forget_t    : forget gate at time/position t
+            in_t        : list of filter inputs W_i x_t, one for each order
+            out_t       : output gate at time/position t; None if no output gate
+
+        Outputs
+        -------
+
+            return hidden/visible states at time/position t
+    '''
+    def update_states(self, hc, forget_t, in_t, out_t):
+        order, n_out, activation = self.order, self.n_out, self.activation
         lst = [ ]
         for i in range(order):
             if hc.ndim > 1:
                 c_i_tm1 = hc[:, n_out*i:n_out*i+n_out]
             else:
                 c_i_tm1 = hc[n_out*i:n_out*i+n_out]
-            in_i_t = layers[i].forward(x)
+            in_i_t = in_t[i]
             if i == 0:
                 c_i_t = forget_t * c_i_tm1 + (1-forget_t) * in_i_t
             elif self.mode == 0:
@@ -471,10 +613,9 @@ class RCNN:
             c_im1_tm1 = c_i_tm1
             c_im1_t = c_i_t
 
-        if not self.has_outgate:
+        if out_t is None:
             h_t = activation(c_i_t + self.bias)
         else:
-            out_t = self.out_gate.forward(x, h_tm1)
             h_t = out_t * activation(c_i_t + self.bias)
         lst.append(h_t)
 
@@ -483,6 +624,33 @@ class RCNN:
         else:
             return T.concatenate(lst)
 
+    '''
+        Compute the input-to-hidden projections of all positions/time at once,
+        i.e. [ W_1 x, ..., W_k x, W_f x + b_f (, W_o x + b_o) ] along the last
+        dimension, so that the recurrent steps only involve h_{t-1}
+    '''
+    def project_inputs(self, x):
+        order, n_in, n_out = self.order, self.n_in, self.n_out
+        layers = self.internal_layers
+        gates = layers[order:]
+        W = T.concatenate(
+                [ layers[i].W for i in range(order) ] + [ g.W[:n_in] for g in gates ],
+                axis = 1
+            )
+        b = T.concatenate(
+                [ T.zeros((n_out*order,), dtype=theano.config.floatX) ] + [ g.b for g in gates ]
+            )
+        return T.dot(x, W) + b
+
+    '''
+        Return the hidden-to-hidden weights of the forget (and output) gate
+        concatenated as one matrix
+    '''
+    def recurrent_weights(self):
+        n_in = self.n_in
+        gates = self.internal_layers[self.order:]
+        return T.concatenate([ g.W[n_in:] for g in gates ], axis=1)
+
     '''
         Apply recurrent steps to input of all positions/time
 
@@ -493,23 +661,33 @@ class RCNN:
             h0          : initial states
             return_c    : whether to return hidden states in addition to visible
                           state
+            mask        : mask of valid positions (len * batch), or None
 
         Outputs
         -------
 
             return visible states (and hidden states) of all positions/time
     '''
-    def forward_all(self, x, h0=None, return_c=False):
+    def forward_all(self, x, h0=None, return_c=False, mask=None):
         if h0 is None:
             if x.ndim > 1:
                 h0 = T.zeros((x.shape[1], self.n_out*(self.order+1)), dtype=theano.config.floatX)
             else:
                 h0 = T.zeros((self.n_out*(self.order+1),), dtype=theano.config.floatX)
-        h, _ = theano.scan(
-                    fn = self.forward,
-                    sequences = x,
-                    outputs_info = [ h0 ]
-                )
+        if self.precompute:
+            h, _ = theano.scan(
+                        fn = self.forward_precomputed,
+                        sequences = self.project_inputs(x),
+                        outputs_info = [ h0 ],
+                        non_sequences = [ self.recurrent_weights() ]
+                    )
+        else:
+            h, _ = theano.scan(
+                        fn = self.forward,
+                        sequences = x,
+                        outputs_info = [ h0 ]
+                    )
+        h = apply_mask(h, mask)
         if return_c:
             return h
         elif x.ndim > 1:
@@ -531,3 +709,98 @@ class RCNN:
         self.bias.set_value(param_list[-1].get_value())
 
 
+'''
+    Compute h_t = a_t * h_{t-1} + b_t for all positions t, using a log-depth
+    (Hillis-Steele) parallel prefix scan over the time axis; h_0 = 0
+
+    After the step with offset k, (a_t, b_t) composes the recurrence over the
+    window (t-2k, t], so ceil(log2(n)) steps cover the whole sequence.
+'''
+def linear_recurrence(a, b):
+    n_steps = T.cast(T.ceil(T.log2(T.cast(a.shape[0], "float64"))), "int64")
+    offsets = T.cast(2**T.arange(T.maximum(n_steps, 1)), "int64")
+
+    def step(k, a_tm, b_tm):
+        b_new = b_tm + a_tm * shift_sequence(b_tm, k)
+        a_new = a_tm * shift_sequence(a_tm, k)
+        return a_new, b_new
+
+    ([a_all, b_all], updates) = theano.scan(
+                fn = step,
+                sequences = offsets,
+                outputs_info = [ a, b ]
+            )
+    return b_all[-1]
+
+
+'''
+    This class implements a variant of RCNN whose forget (and output) gate
+    depends only on the input x_t. Every filter state c_i_t then follows a
+    linear first-order recurrence, so forward_all() evaluates it with a
+    parallel prefix scan of depth O(log n) instead of n sequential steps.
+
+    The parameters are not interchangeable with those of RCNN since the gates
+    have no recurrent weights.
+'''
+class ParallelRCNN(RCNN):
+
+    '''
+        Create a gate layer that depends on x_t only
+    '''
+    def create_gate(self, activation):
+        return Layer(self.n_in, self.n_out, activation,
+                    clip_gradients=self.clip_gradients)
+
+    '''
+        One step of recurrent, for compatibility with RCNN; forward_all() does
+        not use it unless an initial state is given
+    '''
+    def forward(self, x, hc):
+        order = self.order
+        layers = self.internal_layers
+        forget_t = layers[order].forward(x)
+        in_t = [ layers[i].forward(x) for i in range(order) ]
+        out_t = self.out_gate.forward(x) if self.has_outgate else None
+        return self.update_states(hc, forget_t, in_t, out_t)
+
+    def forward_all(self, x, h0=None, return_c=False, mask=None):
+        order, n_out, activation = self.order, self.n_out, self.activation
+        if h0 is not None:
+            h, _ = theano.scan(
+                        fn = self.forward,
+                        sequences = x,
+                        outputs_info = [ h0 ]
+                    )
+        else:
+            lead = (slice(None),) * (x.ndim-1)
+            chunk = lambda v, i: v[lead + (slice(n_out*i, n_out*i+n_out),)]
+            px = self.project_inputs(x)
+
+            forget = self.internal_layers[order].activation(chunk(px, order))
+            lst = [ ]
+            for i in range(order):
+                in_i = chunk(px, i)
+                if i == 0:
+                    u_i = in_i
+                elif self.mode == 0:
+                    u_i = in_i * c_i
+                else:
+                    u_i = in_i + shift_sequence(c_i, 1)
+                c_i = linear_recurrence(forget, (1-forget) * u_i)
+                lst.append(c_i)
+
+            if not self.has_outgate:
+                h_all = activation(c_i + self.bias)
+            else:
+                out = self.out_gate.activation(chunk(px, order+1))
+                h_all = out * activation(c_i + self.bias)
+            lst.append(h_all)
+            h = T.concatenate(lst, axis=x.ndim-1)
+
+        h = apply_mask(h, mask)
+        if return_c:
+            return h
+        elif x.ndim > 1:
+            return h[:,:,self.n_out*self.order:]
+        else:
+            return h[:,self.n_out*self.order:]
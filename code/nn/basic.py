@@ -18,6 +18,9 @@
                                  initial hidden state, and return all hidden
                                  states h1, ..., h_n
 
+    forward_all() also takes an optional (len, batch) mask for batches of
+    sequences padded at the end; states of padded positions are set to zero.
+
     @author: Tao Lei
 '''
 
@@ -61,11 +64,38 @@ class Dropout(object):
 
 def apply_dropout(x, dropout_prob, v2=False):
     '''
-        Apply dropout on x with the specified probability
+        Apply dropout on x with the specified probability. If dropout_prob is
+        None, x is returned as is and no dropout is added to the graph
     '''
+    if dropout_prob is None:
+        return x
     return Dropout(dropout_prob, v2=v2).forward(x)
 
 
+def shift_sequence(x, k):
+    '''
+        Shift the sequence x (len * ...) by k positions forward in time, padding
+        the first k positions with zeros
+    '''
+    pad = T.zeros([ k ] + [ x.shape[i] for i in range(1, x.ndim) ],
+                dtype=theano.config.floatX)
+    return T.concatenate([ pad, x ], axis=0)[:x.shape[0]]
+
+
+def apply_mask(h, mask):
+    '''
+        Zero out the states h (len * batch * d) at padded positions, where mask
+        is a (len * batch) matrix of 0/1. Padding must be at the end of each
+        sequence, so the states of valid positions do not depend on it.
+    '''
+    if mask is None:
+        return h
+    if mask.dtype != theano.config.floatX:
+        mask = T.cast(mask, theano.config.floatX)
+    pattern = tuple(range(mask.ndim)) + ('x',) * (h.ndim - mask.ndim)
+    return h * mask.dimshuffle(pattern)
+
+
 class Layer(object):
     '''
         Basic neural layer -- y = f(Wx+b)
@@ -181,7 +211,7 @@ class RecurrentLayer(Layer):
                 T.dot(x, self.W[:n_in]) + T.dot(h, self.W[n_in:]) + self.b
             )
 
-    def forward_all(self, x, h0=None):
+    def forward_all(self, x, h0=None, mask=None):
         if h0 is None:
             if x.ndim > 1:
                 h0 = T.zeros((x.shape[1], self.n_out), dtype=theano.config.floatX)
@@ -192,7 +222,7 @@ class RecurrentLayer(Layer):
                     sequences = x,
                     outputs_info = [ h0 ]
                 )
-        return h
+        return apply_mask(h, mask)
 
 
 class EmbeddingLayer(object):
@@ -209,7 +239,9 @@ class EmbeddingLayer(object):
         vocab           : an iterator of string tokens; the layer will allocate an ID
                             and a vector for each token in it
         oov             : out-of-vocabulary token
-        embs            : an iterator of (word, vector) pairs; these will be added to
+        embs            : an iterator of (word, vector) pairs, a dict, or a tuple
+                            (words, matrix) whose rows are the vectors of words (see
+                            utils.load_embedding_matrix); these will be added to
                             the layer
         fix_init_embs   : whether to fix the initial word vectors loaded from embs
 
@@ -219,7 +251,14 @@ class EmbeddingLayer(object):
         if embs is not None:
             vocab_map = {}
             emb_vals = []
-            if type(embs)==dict:
+            if type(embs)==tuple:
+                # the vectors are the rows of one matrix; no per-word list needed
+                words, emb_matrix = embs
+                for word in words:
+                    assert word not in vocab_map, "Duplicate words in initial embeddings"
+                    vocab_map[word] = len(vocab_map)
+                emb_vals.append(emb_matrix)
+            elif type(embs)==dict:
                 for word, vector in embs.iteritems():
                     assert word not in vocab_map, "Duplicate words in initial embeddings"
                     vocab_map[word] = len(emb_vals)
@@ -230,14 +269,16 @@ class EmbeddingLayer(object):
                     vocab_map[word] = len(emb_vals)
                     emb_vals.append(vector)
 
-            self.init_end = len(emb_vals) if fix_init_embs else -1
-            if n_d != len(emb_vals[0]):
+            n_init = len(vocab_map)
+            init_d = emb_vals[0].shape[1] if type(embs)==tuple else len(emb_vals[0])
+            self.init_end = n_init if fix_init_embs else -1
+            if n_d != init_d:
                 say("WARNING: n_d ({}) != init word vector size ({}). Using {} instead.\n".format(
-                        n_d, len(emb_vals[0]), len(emb_vals[0])
+                        n_d, init_d, init_d
                     ))
-                n_d = len(emb_vals[0])
+                n_d = init_d
 
-            say("{} pre-trained embeddings loaded.\n".format(len(emb_vals)))
+            say("{} pre-trained embeddings loaded.\n".format(n_init))
 
             for word in vocab:
                 if word not in vocab_map:
@@ -322,6 +363,31 @@ class EmbeddingLayer(object):
         '''
         return self.embeddings[x]
 
+    def forward_rows(self, x):
+        '''
+            Fetch the word embeddings given word IDs x through the rows of the
+            unique IDs in x, so that an optimizer only updates the vectors of
+            the words in x
+
+            Inputs
+            ------
+
+            x           : a theano vector of integer IDs
+
+
+            Outputs
+            -------
+
+            a theano matrix of word embeddings, and the list of parameters
+            [ embeddings[unique trainable IDs in x] ] (an AdvancedSubtensor1)
+        '''
+        # unique IDs are sorted, so the fixed ones come first
+        uids, inverse = T.extra_ops.Unique(return_inverse=True)(x)
+        n_fixed = T.sum(T.lt(uids, self.init_end)) if self.init_end > -1 else 0
+        rows = self.embeddings[uids[n_fixed:]]
+        fixed_rows = self.embeddings[uids[:n_fixed]]
+        return T.concatenate([ fixed_rows, rows ])[inverse], [ rows ]
+
     @property
     def params(self):
         return [ self.embeddings_trainable ]
@@ -334,14 +400,22 @@ class EmbeddingLayer(object):
 class LSTM(Layer):
     '''
         LSTM implementation.
+
+        Inputs
+        ------
+
+            precompute  : whether forward_all() computes the input projections of
+                          all gates for all positions with one matrix product
+                          before the recurrent steps (default)
     '''
     def __init__(self, n_in, n_out, activation=tanh,
-            clip_gradients=False):
+            clip_gradients=False, precompute=True):
 
         self.n_in = n_in
         self.n_out = n_out
         self.activation = activation
         self.clip_gradients = clip_gradients
+        self.precompute = precompute
 
         self.in_gate = RecurrentLayer(n_in, n_out, sigmoid, clip_gradients)
         self.forget_gate = RecurrentLayer(n_in, n_out, sigmoid, clip_gradients)
@@ -389,7 +463,57 @@ class LSTM(Layer):
         else:
             return T.concatenate([ c_t, h_t ])
 
-    def forward_all(self, x, h0=None, return_c=False):
+    def forward_precomputed(self, px, hc, W_h):
+        '''
+            Apply one recurrent step of LSTM given the input projections px of the
+            current position (see project_inputs()). All gates share a single
+            product of h_tm1 with the concatenated recurrent weights W_h.
+        '''
+        n_out = self.n_out
+
+        if hc.ndim > 1:
+            c_tm1 = hc[:, :n_out]
+            h_tm1 = hc[:, n_out:]
+        else:
+            c_tm1 = hc[:n_out]
+            h_tm1 = hc[n_out:]
+
+        z = px + T.dot(h_tm1, W_h)
+        if hc.ndim > 1:
+            z_in, z_i, z_f, z_o = [ z[:, n_out*k:n_out*(k+1)] for k in range(4) ]
+        else:
+            z_in, z_i, z_f, z_o = [ z[n_out*k:n_out*(k+1)] for k in range(4) ]
+
+        in_t = self.in_gate.activation(z_i)
+        forget_t = self.forget_gate.activation(z_f)
+        out_t = self.out_gate.activation(z_o)
+
+        c_t = forget_t * c_tm1 + in_t * self.input_layer.activation(z_in)
+        h_t = out_t * T.tanh(c_t)
+
+        if hc.ndim > 1:
+            return T.concatenate([ c_t, h_t ], axis=1)
+        else:
+            return T.concatenate([ c_t, h_t ])
+
+    def project_inputs(self, x):
+        '''
+            Return x W_x + b for all positions, where W_x and b are the input
+            weights and biases of all internal layers concatenated together
+        '''
+        n_in = self.n_in
+        W = T.concatenate([ layer.W[:n_in] for layer in self.internal_layers ], axis=1)
+        b = T.concatenate([ layer.b for layer in self.internal_layers ])
+        return T.dot(x, W) + b
+
+    def recurrent_weights(self):
+        '''
+            Return the recurrent weights of all internal layers as one matrix
+        '''
+        n_in = self.n_in
+        return T.concatenate([ layer.W[n_in:] for layer in self.internal_layers ], axis=1)
+
+    def forward_all(self, x, h0=None, return_c=False, mask=None):
         '''
             Apply recurrent steps of LSTM on all inputs {x_1, ..., x_n}
 
@@ -400,6 +524,7 @@ class LSTM(Layer):
             h0          : the initial states [ c_0, h_0 ] including both hidden and
                             visible states
             return_c    : whether to return hidden state {c1, ..., c_n}
+            mask        : (n*batch) mask of valid positions, or None
 
 
             Outputs
@@ -414,11 +539,20 @@ class LSTM(Layer):
                 h0 = T.zeros((x.shape[1], self.n_out*2), dtype=theano.config.floatX)
             else:
                 h0 = T.zeros((self.n_out*2,), dtype=theano.config.floatX)
-        h, _ = theano.scan(
-                    fn = self.forward,
-                    sequences = x,
-                    outputs_info = [ h0 ]
-                )
+        if self.precompute:
+            h, _ = theano.scan(
+                        fn = self.forward_precomputed,
+                        sequences = self.project_inputs(x),
+                        outputs_info = [ h0 ],
+                        non_sequences = [ self.recurrent_weights() ]
+                    )
+        else:
+            h, _ = theano.scan(
+                        fn = self.forward,
+                        sequences = x,
+                        outputs_info = [ h0 ]
+                    )
+        h = apply_mask(h, mask)
         if return_c:
             return h
         elif x.ndim > 1:
@@ -441,14 +575,22 @@ class LSTM(Layer):
 class GRU(Layer):
     '''
         GRU implementation
+
+        Inputs
+        ------
+
+            precompute  : whether forward_all() computes the input projections of
+                          all gates for all positions with one matrix product
+                          before the recurrent steps (default)
     '''
     def __init__(self, n_in, n_out, activation=tanh,
-            clip_gradients=False):
+            clip_gradients=False, precompute=True):
 
         self.n_in = n_in
         self.n_out = n_out
         self.activation = activation
         self.clip_gradients = clip_gradients
+        self.precompute = precompute
 
         self.reset_gate = RecurrentLayer(n_in, n_out, sigmoid, clip_gradients)
         self.update_gate = RecurrentLayer(n_in, n_out, sigmoid, clip_gradients)
@@ -467,18 +609,70 @@ class GRU(Layer):
         h_out = update_t*h_new + (1.0-update_t)*h
         return h_out
 
-    def forward_all(self, x, h0=None, return_c=True):
+    def forward_precomputed(self, px, h, W_h, W_in):
+        '''
+            Apply one recurrent step of GRU given the input projections px of the
+            current position (see project_inputs()). The reset and update gates
+            share one product of h with W_h; the candidate state still needs
+            its own product since it is computed from reset_t * h.
+        '''
+        n_out = self.n_out
+
+        z = T.dot(h, W_h)
+        if h.ndim > 1:
+            px_r, px_u, px_in = [ px[:, n_out*k:n_out*(k+1)] for k in range(3) ]
+            z_r, z_u = z[:, :n_out], z[:, n_out:]
+        else:
+            px_r, px_u, px_in = [ px[n_out*k:n_out*(k+1)] for k in range(3) ]
+            z_r, z_u = z[:n_out], z[n_out:]
+
+        reset_t = self.reset_gate.activation(px_r + z_r)
+        update_t = self.update_gate.activation(px_u + z_u)
+        h_reset = reset_t * h
+
+        h_new = self.input_layer.activation(px_in + T.dot(h_reset, W_in))
+        h_out = update_t*h_new + (1.0-update_t)*h
+        return h_out
+
+    def project_inputs(self, x):
+        '''
+            Return x W_x + b for all positions, where W_x and b are the input
+            weights and biases of all internal layers concatenated together
+        '''
+        n_in = self.n_in
+        W = T.concatenate([ layer.W[:n_in] for layer in self.internal_layers ], axis=1)
+        b = T.concatenate([ layer.b for layer in self.internal_layers ])
+        return T.dot(x, W) + b
+
+    def recurrent_weights(self):
+        '''
+            Return the recurrent weights of the reset and update gates as one
+            matrix, and the recurrent weights of the candidate state
+        '''
+        n_in = self.n_in
+        W_h = T.concatenate([ self.reset_gate.W[n_in:], self.update_gate.W[n_in:] ], axis=1)
+        return [ W_h, self.input_layer.W[n_in:] ]
+
+    def forward_all(self, x, h0=None, return_c=True, mask=None):
         if h0 is None:
             if x.ndim > 1:
                 h0 = T.zeros((x.shape[1], self.n_out), dtype=theano.config.floatX)
             else:
                 h0 = T.zeros((self.n_out,), dtype=theano.config.floatX)
-        h, _ = theano.scan(
-                    fn = self.forward,
-                    sequences = x,
-                    outputs_info = [ h0 ]
-                )
-        return h
+        if self.precompute:
+            h, _ = theano.scan(
+                        fn = self.forward_precomputed,
+                        sequences = self.project_inputs(x),
+                        outputs_info = [ h0 ],
+                        non_sequences = self.recurrent_weights()
+                    )
+        else:
+            h, _ = theano.scan(
+                        fn = self.forward,
+                        sequences = x,
+                        outputs_info = [ h0 ]
+                    )
+        return apply_mask(h, mask)
 
     @property
     def params(self):
@@ -501,15 +695,19 @@ class CNN(Layer):
         ------
 
             order       : feature filter width
+            precompute  : whether forward_all() applies the filters to all positions
+                          at once as shifted matrix products (default) instead of
+                          running theano.scan
     '''
     def __init__(self, n_in, n_out, activation=tanh,
-            order=1, clip_gradients=False):
+            order=1, clip_gradients=False, precompute=True):
 
         self.n_in = n_in
         self.n_out = n_out
         self.activation = activation
         self.order = order
         self.clip_gradients = clip_gradients
+        self.precompute = precompute
 
         internal_layers = self.internal_layers = [ ]
         for i in range(order):
@@ -548,11 +746,39 @@ class CNN(Layer):
         else:
             return T.concatenate(lst)
 
-    def forward_all(self, x, h0=None, return_c=False):
+    def forward_parallel(self, x):
+        '''
+            Compute the states of all positions without scan. The partial sums
+            satisfy c_i_t = x_t W_i + c_{i-1}_{t-1}, so each order only needs a
+            shift of the previous one; all x_t W_i come from one matrix product.
+        '''
+        order, n_out, activation = self.order, self.n_out, self.activation
+        layers = self.internal_layers
+        W = T.concatenate([ layer.W for layer in layers ], axis=1)
+        proj = T.dot(x, W)
+        lead = (slice(None),) * (x.ndim-1)
+        lst = [ ]
+        for i in range(order):
+            in_i = proj[lead + (slice(n_out*i, n_out*i+n_out),)]
+            if i == 0:
+                c_i = in_i
+            else:
+                c_i = in_i + shift_sequence(c_i, 1)
+            lst.append(c_i)
+        h = activation(c_i + self.bias)
+        lst.append(h)
+        return T.concatenate(lst, axis=x.ndim-1)
+
+    def forward_all(self, x, h0=None, return_c=False, mask=None):
         '''
             Apply filters to every local chunk of the sequence x. Return the feature
             maps as a matrix, or a tensor instead if x is a batch of sequences
         '''
+        if self.precompute and h0 is None:
+            h = apply_mask(self.forward_parallel(x), mask)
+            if return_c:
+                return h
+            return h[(slice(None),) * (x.ndim-1) + (slice(self.n_out*self.order, None),)]
         if h0 is None:
             if x.ndim > 1:
                 h0 = T.zeros((x.shape[1], self.n_out*(self.order+1)), dtype=theano.config.floatX)
@@ -563,6 +789,7 @@ class CNN(Layer):
                     sequences = x,
                     outputs_info = [ h0 ]
                 )
+        h = apply_mask(h, mask)
         if return_c:
             return h
         elif x.ndim > 1:
@@ -83,6 +83,61 @@ def create_optimization_updates(
 
     return updates, lr, g_norm, gsums, xsums, max_norm
 
+def get_optimizer_state(updates, params):
+    '''
+        Return the shared variables of the optimizer state in the updates of
+        create_optimization_updates (accumulators and Adam's step counter),
+        i.e. the updated variables that are not parameters. Saving and
+        restoring their values resumes the optimization exactly.
+    '''
+    param_vars = set(get_subtensor_op_inputs(p)[0] if is_subtensor_op(p) else p
+                        for p in params)
+    return [ v for v in updates.keys() if v not in param_vars ]
+
+class FlatParams(object):
+    '''
+        A single flat shared vector backing the shared variables params. Graphs
+        use the params through views of the vector (see replace()), so that
+        the gradient norm, clipping and updates of create_optimization_updates
+        are a few vector ops per step for the vector as the only param.
+
+        The values of params are only copied into the vector by pack() and
+        back by unpack(), e.g. before saving them.
+    '''
+    def __init__(self, params):
+        self.params = params
+        self.shapes = [ p.get_value(borrow=True).shape for p in params ]
+        self.offsets = [ 0 ]
+        for shape in self.shapes:
+            self.offsets.append(self.offsets[-1] + int(np.prod(shape)))
+        self.flat = theano.shared(np.zeros(self.offsets[-1],
+                                dtype=theano.config.floatX), name="flat_params")
+        self.views = OrderedDict(
+                (p, self.flat[a:b].reshape(shape))
+                for p, shape, a, b in zip(params, self.shapes,
+                                self.offsets[:-1], self.offsets[1:])
+            )
+        self.pack()
+
+    def replace(self, outputs):
+        '''
+            Return outputs (a variable or a list of them) with the params
+            replaced by views of the flat vector
+        '''
+        return theano.clone(outputs, replace=self.views)
+
+    def pack(self):
+        self.flat.set_value(np.concatenate(
+                [ p.get_value(borrow=True).ravel() for p in self.params ]
+            ).astype(theano.config.floatX), borrow=True)
+
+    def unpack(self):
+        # one copy of the vector; the params become views of it
+        value = self.flat.get_value()
+        for p, shape, a, b in zip(self.params, self.shapes,
+                        self.offsets[:-1], self.offsets[1:]):
+            p.set_value(value[a:b].reshape(shape), borrow=True)
+
 def is_subtensor_op(p):
     if hasattr(p, 'owner') and hasattr(p.owner, 'op'):
         return isinstance(p.owner.op, T.AdvancedSubtensor1) or \
@@ -166,7 +221,25 @@ def create_adam_updates(updates, params, gparams, gsums, xsums, \
     omb2_t = 1.0 - beta2**i_t
     lr_t = lr * (T.sqrt(omb2_t) / omb1_t)
     for p, g, m, v in zip(params, gparams, gsums, xsums):
-        if is_subtensor_op(p):
+        if is_subtensor_op(p) and isinstance(p.owner.op, T.AdvancedSubtensor1):
+            # sparse rows (e.g. the word vectors in a batch): only these rows
+            # are updated, so each row keeps its own step count for the bias
+            # correction
+            origin, indexes = get_subtensor_op_inputs(p)
+            steps = theano.shared(np.zeros(origin.get_value(borrow=True).shape[0],
+                                 dtype=theano.config.floatX))
+            steps_t = steps[indexes] + 1.0
+            lr_rows = lr * (T.sqrt(1.0 - beta2**steps_t) / (1.0 - beta1**steps_t))
+            m_sub = m[indexes]
+            v_sub = v[indexes]
+            m_t = beta1*m_sub + (1.0-beta1)*g
+            v_t = beta2*v_sub + (1.0-beta2)*T.sqr(g)
+            g_t = m_t / (T.sqrt(v_t) + eps)
+            updates[steps] = T.set_subtensor(steps[indexes], steps_t)
+            updates[m] = T.set_subtensor(m_sub, m_t)
+            updates[v] = T.set_subtensor(v_sub, v_t)
+            updates[origin] = T.inc_subtensor(p, -lr_rows.dimshuffle(0, 'x')*g_t)
+        elif is_subtensor_op(p):
             origin, indexes = get_subtensor_op_inputs(p)
             m_sub = m[indexes]
             v_sub = v[indexes]
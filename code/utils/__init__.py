@@ -1,6 +1,7 @@
 
 import sys
 import gzip
+import multiprocessing
 
 import numpy as np
 
@@ -24,3 +25,121 @@ def load_embedding_iterator(path):
                 vals = np.array([ float(x) for x in parts[1:] ])
                 yield word, vals
 
+def embedding_vocab_path(path):
+    '''
+        Path of the vocabulary file that goes with the embedding matrix at path
+    '''
+    if path.endswith(".npy"):
+        path = path[:-4]
+    return path + ".vocab"
+
+def save_embedding_matrix(path, words, vectors):
+    '''
+        Save embeddings as a float32 .npy matrix at path and the words (one per
+        line, in the order of the rows) next to it
+    '''
+    if not path.endswith(".npy"):
+        path += ".npy"
+    np.save(path, np.asarray(vectors, dtype=np.float32))
+    with open(embedding_vocab_path(path), "w") as fout:
+        for word in words:
+            fout.write(word + "\n")
+
+def load_embedding_matrix(path, mmap=True):
+    '''
+        Load embeddings saved by save_embedding_matrix() or
+        convert_embedding_file(). Return the list of words and the matrix,
+        memory-mapped (read-only) by default.
+    '''
+    if not path.endswith(".npy"):
+        path += ".npy"
+    with open(embedding_vocab_path(path)) as fin:
+        words = [ line.rstrip("\n") for line in fin ]
+    matrix = np.load(path, mmap_mode="r" if mmap else None)
+    assert len(words) == len(matrix), "Vocabulary and embedding matrix do not match"
+    return words, matrix
+
+def filter_embeddings(embs, vocab):
+    '''
+        Keep only the embeddings of words in vocab, preserving their order. embs
+        is a (words, matrix) tuple, a dict, or an iterator of (word, vector)
+        pairs; a tuple or a list of pairs is returned accordingly.
+    '''
+    if type(embs) == tuple:
+        words, matrix = embs
+        rows = [ i for i, word in enumerate(words) if word in vocab ]
+        return [ words[i] for i in rows ], np.asarray(matrix[rows])
+    if type(embs) == dict:
+        embs = embs.iteritems()
+    return [ (word, vector) for word, vector in embs if word in vocab ]
+
+def read_embedding_chunks(path, chunk_size):
+    '''
+        Yield the non-empty lines of a text embedding file in lists of
+        chunk_size lines. Like load_embedding_iterator(), the first line is
+        skipped.
+    '''
+    file_open = gzip.open if path.endswith(".gz") else open
+    chunk = [ ]
+    skip = True
+    with file_open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                if skip:
+                    skip = False
+                    continue
+                chunk.append(line)
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = [ ]
+    if chunk:
+        yield chunk
+
+def parse_embedding_lines(lines):
+    '''
+        Parse lines of "word v_1 ... v_d" into a list of words and a float32
+        matrix, converting all the values with a single numpy call
+    '''
+    words = [ ]
+    values = [ ]
+    for line in lines:
+        word, vals = line.split(None, 1)
+        words.append(word)
+        values.append(vals)
+    matrix = np.fromstring(" ".join(values), dtype=np.float32, sep=" ")
+    return words, matrix.reshape((len(words), -1))
+
+def convert_embedding_file(path, out_path, processes=None, chunk_size=10000):
+    '''
+        One-time conversion of a text embedding file (e.g. GloVe, optionally
+        gzipped) into the binary format of save_embedding_matrix(). Chunks of
+        lines are parsed by a pool of processes and written into a .npy file
+        in place. Return the result of load_embedding_matrix(out_path).
+    '''
+    if not out_path.endswith(".npy"):
+        out_path += ".npy"
+    num_words = sum(len(chunk) for chunk in read_embedding_chunks(path, chunk_size))
+    words = [ ]
+    matrix = None
+    pool = multiprocessing.Pool(processes)
+    try:
+        for chunk_words, chunk in pool.imap(parse_embedding_lines,
+                                            read_embedding_chunks(path, chunk_size)):
+            if matrix is None:
+                matrix = np.lib.format.open_memmap(out_path, mode="w+",
+                            dtype=np.float32, shape=(num_words, chunk.shape[1]))
+            matrix[len(words):len(words)+len(chunk_words)] = chunk
+            words.extend(chunk_words)
+    finally:
+        pool.close()
+        pool.join()
+    assert len(words) == num_words
+    matrix.flush()
+    del matrix
+    with open(embedding_vocab_path(out_path), "w") as fout:
+        for word in words:
+            fout.write(word + "\n")
+    say("{} embeddings converted to {}\n".format(num_words, out_path))
+    return load_embedding_matrix(out_path)
+